@@ -1,6 +1,8 @@
+import importlib
 import numpy as np
-import cvxpy as cp
-import sys
+from collections import defaultdict, deque
+from rewiring_flow import flow_rewiring, rewiring_objective, InfeasibleRewiring
+from instrument import NULL
 
 
 class SwitchSet(object):
@@ -23,17 +25,94 @@ class SwitchSet(object):
     self.spine_numports = wiring_matrix.sum(axis=0)
 
 
+class LazyModule(object):
+  """ Stand-in for a module that is slow to import, importing it on first
+  attribute access """
+  def __init__(self, name):
+    self.name = name
+    self.module = None
+
+  def __getattr__(self, attr):
+    if self.module is None:
+      self.module = importlib.import_module(self.name)
+    return getattr(self.module, attr)
+
+
+cp = LazyModule('cvxpy')
+
+
+# solver -> (time limit option, relative gap option, options dict the two
+# belong to or None for top level keyword arguments, time limit units/s)
+SOLVER_LIMITS = {
+  'HIGHS': ('time_limit', 'mip_rel_gap', None, 1),
+  'SCIPY': ('time_limit', 'mip_rel_gap', 'scipy_options', 1),
+  'CBC': ('maximumSeconds', 'allowableFractionGap', None, 1),
+  'GLPK_MI': ('tm_lim', 'mip_gap', None, 1000),
+  'SCIP': ('limits/time', 'limits/gap', 'scip_params', 1),
+  'GUROBI': ('TimeLimit', 'MIPGap', None, 1),
+  'CPLEX': ('timelimit', 'mip.tolerances.mipgap', 'cplex_params', 1),
+}
+
+
+class RewirePlan(list):
+  """ Link instructions of a rewiring, with the quality of the target wiring
+
+  Attributes:
+        optimal (bool): whether the target wiring is proven optimal
+        gap (float): relative gap between the target wiring's objective and
+          the LP relaxation bound, None if unknown
+        status (string): solver status, 'heuristic' when the solver gave
+          no wiring in time and the greedy wiring was used, 'cached' for
+          cached solutions
+
+  """
+  def __init__(self, instructions=(), optimal=True, gap=0.0, status='optimal'):
+    super(RewirePlan, self).__init__(instructions)
+    self.optimal = optimal
+    self.gap = gap
+    self.status = status
+
+
 class MinimalRewiringILP(object):
   """ Main class to do minimal rewiring using ILP 
   Args:
         initial_wiring (np.ndarray): initial number of links between every pair
             of spine block and server block
+        backend (string or callable): "ilp", "flow" or a callable taking this
+            object and returning the target wiring
+        cross_check (bool): solve with both built-in backends and check that
+            they reach the same objective
+        instrument (Instrumentation): records phase timings and counters,
+            disabled if None
+        cache (RewiringCache): cache of solved scenarios checked before
+            solving, disabled if None
+        time_limit (float): seconds the ILP solver may run, unbounded if
+            None. Past it the best wiring found so far is used, or the
+            greedy wiring if there is none.
+        mip_gap (float): relative optimality gap at which the ILP solver
+            may stop, solver default if None
 
   """
-  def __init__(self, initial_wiring):
+  def __init__(self, initial_wiring, backend="ilp", cross_check=False, 
+               instrument=None, cache=None, time_limit=None, mip_gap=None):
     self.switch_set = SwitchSet()
     self.switch_set.from_wiring_matrix(initial_wiring)
     self.current_wiring = initial_wiring
+    self.backend = backend
+    self.cross_check = cross_check
+    self.side_constraints = []            # callables: x (problem_shape) -> constraints
+    self.problem = None                   # persistent problem, see build_problem
+    self.problem_key = None               # what the persistent problem was built for
+    self.spare_blocks = 4                 # room for blocks added without a rebuild
+    self.solver_opts = {}                 # extra keyword args for problem.solve
+    self.instrument = instrument or NULL
+    self.cache = cache
+    self.time_limit = time_limit
+    self.mip_gap = mip_gap
+    self.relaxation = None                # LP relaxation, see lower_bound
+    self.anchor = None                    # wiring the objective is pulled towards
+    self.anchor_weight = 0.0              # cost per link of differing from anchor
+    self.quality = {}                     # RewirePlan attributes of the last solve
 
   def rewire(self, level, num_ports):
     """ Function to compute rewiring after adding a new block 
@@ -46,8 +125,123 @@ class MinimalRewiringILP(object):
             that will result in the new block being added using minimal change
             of links
 
+    """
+    return self.rewire_batch([(level, num_ports)])
+
+  def rewire_batch(self, additions):
+    """ Function to compute rewiring after adding several blocks at once,
+    solving a single time for the final target wiring
+    Args:
+          additions (list): (level, num_ports) pairs, in the order the new
+            blocks are indexed
+
+    Returns:
+          link_movements (RewirePlan): list of "connect" or "disconnect" 
+            instructions that take the current wiring directly to the final
+            target wiring, with whether that wiring is optimal
+
+    """
+    with self.instrument.expansion(additions=list(additions)):
+      key = self.cache_key(additions)
+      lm = self.cached_batch(key, additions)
+      if lm is not None:
+        return RewirePlan(lm, **self.quality)
+
+      old_wiring, new_wiring = self.solve_batch(additions)
+
+      # identify link movements
+      with self.instrument.phase('link_moves'):
+        lm = self.link_moves(old_wiring, new_wiring)
+      self.instrument.set('links_moved', 
+                          sum(1 for action in lm if action[0] == "CONNECT"))
+      if key is not None and self.quality['optimal']:
+        self.cache.put(key, new_wiring, lm)
+
+    return RewirePlan(lm, **self.quality)
+
+  def rewire_iter(self, additions):
+    """ Generator version of rewire_batch: solves for the target wiring on
+    first use, then yields the link instructions one at a time, so that
+    they can be applied while the rest of the plan is being scheduled
+    Args:
+          additions (list): (level, num_ports) pairs, in the order the new
+            blocks are indexed
+
+    Yields:
+          instruction (tuple): ("CONNECT" or "DISCONNECT", server, spine)
+
+    """
+    with self.instrument.expansion(additions=list(additions)):
+      key = self.cache_key(additions)
+      cached = self.cached_batch(key, additions)
+      if cached is None:
+        old_wiring, new_wiring = self.solve_batch(additions)
+    if cached is not None:
+      for instruction in cached:
+        yield instruction
+      return
+
+    plan = []
+    for instruction in self.iter_link_moves(old_wiring, new_wiring):
+      plan.append(instruction)
+      yield instruction
+    if key is not None and self.quality['optimal']:
+      self.cache.put(key, new_wiring, plan)
+
+  def cache_key(self, additions):
+    """ Cache key of adding /additions/ to the current state, None when
+    caching is disabled or the scenario depends on side constraints """
+    if self.cache is None or self.side_constraints or self.anchored() or \
+      callable(self.backend):
+      return None
+    return self.cache.key(self.current_wiring, self.switch_set.server_numports,
+                          self.switch_set.spine_numports, additions, self.backend)
+
+  def cached_batch(self, key, additions):
+    """ Apply the cached solution of /key/ if there is one
+
+    Returns:
+          link_movements (list): cached plan, or None on a cache miss
+
+    """
+    cached = self.cache.get(key) if key is not None else None
+    self.instrument.set('cache_hit', cached is not None)
+    if cached is None:
+      return None
+    wiring, plan = cached
+    self.quality = dict(optimal=True, gap=0.0, status='cached')
+    for level, num_ports in additions:
+      self.add_block(level, num_ports)
+    self.nsp = self.switch_set.num_spine
+    self.nsv = self.switch_set.num_server
+    self.current_wiring = wiring
+    return plan
+
+  def solve_batch(self, additions):
+    """ Register /additions/, solve for the target wiring and make it the
+    current wiring
+
+    Returns:
+          old_wiring (np.ndarray): previous wiring padded to the new shape
+          new_wiring (np.ndarray): target wiring
+
     """
     # update switch set
+    for level, num_ports in additions:
+      self.add_block(level, num_ports)
+
+    self.nsp = self.switch_set.num_spine
+    self.nsv = self.switch_set.num_server
+
+    old_wiring = self.padded_wiring().astype(int)
+    new_wiring = self.solve()
+
+    # update wiring 
+    self.current_wiring = new_wiring
+    return old_wiring, new_wiring
+
+  def add_block(self, level, num_ports):
+    """ Register a new spine or server block in the switch set """
     if level == "spine":
       self.switch_set.num_spine += 1
       self.switch_set.spine_numports = np.append(self.switch_set.spine_numports, num_ports)
@@ -55,44 +249,264 @@ class MinimalRewiringILP(object):
       self.switch_set.num_server += 1
       self.switch_set.server_numports = np.append(self.switch_set.server_numports, num_ports)
 
-    self.nsp = self.switch_set.num_spine
-    self.nsv = self.switch_set.num_server
-    # prepare ILP equations
-    self.prepare_variables()
-    self.prepare_constraints()
-    self.prepare_objective()
+  def solve(self):
+    """ Solve for the target wiring of the current switch set with the
+    configured backend. The flow backend cannot express side constraints or
+    an anchor, so those always fall back to the ILP.
 
-    # run ILP
-    problem = cp.Problem(cp.Minimize(self.objective), self.constraints)
-    solution = problem.solve()
+    Returns:
+          new_wiring (np.ndarray): target number of links between every pair
+            of server block and spine block
 
-    if solution is None:
-      raise Exception("No rewiring found under given parameters.")
-    
-    new_wiring = self.variables.value[:self.nsp*self.nsv].reshape(self.nsv, self.nsp)
-    old_wiring = np.zeros([self.nsv, self.nsp])
-    old_wiring[:self.current_wiring.shape[0],:self.current_wiring.shape[1]] = self.current_wiring
-    
-    new_wiring = np.round(new_wiring)
-    old_wiring = np.round(old_wiring)
+    """
+    backend = self.backend
+    if backend == "flow" and (self.side_constraints or self.anchored()):
+      backend = "ilp"
 
-    # identify link movements
-    lm = self.link_moves(old_wiring.astype(np.int), new_wiring.astype(np.int))
+    self.instrument.set('backend', getattr(backend, '__name__', backend))
+    if callable(backend):
+      with self.instrument.phase('solve'):
+        wiring = backend(self)
+      self.quality = dict(optimal=False, gap=None, status='unknown')
+    elif backend == "flow":
+      wiring = self.solve_flow()
+      self.quality = dict(optimal=True, gap=0.0, status='optimal')
+    elif backend == "ilp":
+      wiring = self.solve_ilp()
+    else:
+      raise ValueError("Unknown rewiring backend '{}'.".format(backend))
 
-    # update wiring 
-    self.current_wiring = new_wiring.astype(np.int)
+    if self.cross_check and not self.side_constraints and not self.anchored():
+      self.check_backends(wiring)
+    return wiring
+
+  def check_backends(self, wiring):
+    """ Check /wiring/ against the objective reached by both backends """
+    current = self.padded_wiring()
+    objective = rewiring_objective(wiring, current)
+    for name in ("ilp", "flow"):
+      other = rewiring_objective(getattr(self, "solve_" + name)(), current)
+      if abs(other - objective) > 1e-6:
+        raise Exception("Backend '{}' reached objective {} instead of {}."
+                        .format(name, other, objective))
+
+  def solve_flow(self):
+    """ Solve the rewiring problem exactly as a max-flow, see flow_rewiring """
+    with self.instrument.phase('solve'):
+      return flow_rewiring(self.padded_wiring(),
+                           self.switch_set.server_numports,
+                           self.switch_set.spine_numports)
+
+  def solve_ilp(self):
+    """ Solve for the target wiring with the ILP, reusing the persistent
+    problem as long as the blocks fit in its shape, see build_key. The
+    greedy wiring warm starts the solver and replaces its solution when the
+    solver stops without one, e.g. at the time limit. """
+    if self.problem is None or self.problem_key != self.build_key():
+      with self.instrument.phase('ilp_build'):
+        self.build_problem()
+      self.instrument.set('constraints_built', len(self.constraints))
+    self.update_parameters()
 
-    return lm
+    with self.instrument.phase('heuristic'):
+      start = self.greedy_wiring()
+    current = self.padded_wiring()
+    self.x.value = self.pad(start)
+    self.x_p.value = self.pad(np.abs(start - current))
+    start_feasible = all(np.all(c.value()) for c in self.constraints)
+
+    try:
+      with self.instrument.phase('solve'):
+        self.problem.solve(warm_start=True, **self.solver_options())
+      status = self.problem.status
+    except cp.error.SolverError:
+      status = 'solver_error'
+    if self.instrument.enabled:
+      self.instrument.set('solver_status', status)
+      if status != 'solver_error':
+        self.instrument.set('solver_time', self.problem.solver_stats.solve_time)
+
+    if status in ('infeasible', 'infeasible_inaccurate'):
+      raise InfeasibleRewiring("No rewiring found under given parameters.")
+    if self.x.value is None:
+      if not start_feasible:
+        raise InfeasibleRewiring("No rewiring found under given parameters.")
+      wiring, status = start, 'heuristic'
+    else:
+      wiring = np.round(self.x.value[:self.nsv, :self.nsp]).astype(int)
+      # an interrupted solver may hold a worse wiring than its warm start
+      if status != 'optimal' and start_feasible and \
+        self.objective_value(start) < self.objective_value(wiring):
+        wiring, status = start, 'heuristic'
+
+    gap = 0.0
+    if status != 'optimal' or self.mip_gap is not None:
+      gap = self.optimality_gap(self.objective_value(wiring))
+    self.quality = dict(optimal=gap == 0.0, gap=gap, status=status)
+    self.instrument.set('gap', gap)
+    return wiring
+
+  def solver_options(self):
+    """ Keyword arguments of problem.solve: solver_opts plus the time limit
+    and gap tolerance in the chosen solver's own option names """
+    opts = dict(self.solver_opts)
+    if self.time_limit is None and self.mip_gap is None:
+      return opts
+
+    solver = opts.get('solver')
+    if solver is None:
+      installed = cp.installed_solvers()
+      solver = next((name for name in SOLVER_LIMITS if name in installed), None)
+      if solver is None:
+        raise ValueError("No installed solver supports time limits.")
+      opts['solver'] = solver
+    if solver not in SOLVER_LIMITS:
+      raise ValueError("Unknown time limit options of solver '{}'.".format(solver))
+
+    time_key, gap_key, group, scale = SOLVER_LIMITS[solver]
+    limits = {}
+    if self.time_limit is not None:
+      limits[time_key] = self.time_limit * scale
+    if self.mip_gap is not None:
+      limits[gap_key] = self.mip_gap
+    if group is None:
+      opts.update(limits)
+    else:
+      opts[group] = dict(opts.get(group, {}), **limits)
+    return opts
+
+  def greedy_wiring(self):
+    """ Feasible floor/ceil wiring built greedily: every cell starts at its
+    floor, then each server block raises the cells that keep an existing
+    link, preferring the spine blocks with the most free ports. Ignores
+    side constraints.
+
+    Returns:
+          wiring (np.ndarray): wiring satisfying the port and even
+            distribution constraints
+
+    """
+    lower, upper = self.bounds()
+    lower, upper = lower.astype(int), upper.astype(int)
+    current = self.padded_wiring()
+    wiring = lower.copy()
+    row_cap = np.round(self.switch_set.server_numports).astype(int) - lower.sum(axis=1)
+    col_cap = np.round(self.switch_set.spine_numports).astype(int) - lower.sum(axis=0)
+    if (row_cap < 0).any() or (col_cap < 0).any():
+      raise InfeasibleRewiring("No rewiring found under given parameters.")
+
+    for i in np.argsort(-row_cap, kind='stable'):
+      cols = np.flatnonzero((upper[i] > lower[i]) & (current[i] > lower[i]) & (col_cap > 0))
+      cols = cols[np.argsort(-col_cap[cols], kind='stable')][:row_cap[i]]
+      wiring[i, cols] += 1
+      col_cap[cols] -= 1
+    return wiring
+
+  def optimality_gap(self, objective):
+    """ Relative gap between /objective/ and the LP relaxation bound, None
+    if the relaxation cannot be solved """
+    bound = self.lower_bound()
+    if bound is None:
+      return None
+    if not self.anchored():
+      # objectives of integer wirings are integers, so the bound rounds up
+      bound = np.ceil(bound - 1e-6)
+    return float(max(0.0, objective - bound) / max(1.0, abs(objective)))
+
+  def lower_bound(self):
+    """ Optimal objective of the LP relaxation of the current problem """
+    if self.relaxation is None or self.relaxation[0] != self.problem_key:
+      x = cp.Variable(self.problem_shape)
+      x_p = cp.Variable(self.problem_shape)
+      self.relaxation = (self.problem_key, 
+                         cp.Problem(cp.Minimize(self.objective_expr(x, x_p)),
+                                    self.rewiring_constraints(x, x_p)))
+    try:
+      with self.instrument.phase('bound'):
+        bound = self.relaxation[1].solve()
+    except cp.error.SolverError:
+      return None
+    return bound if self.relaxation[1].status == 'optimal' else None
+
+  def anchored(self):
+    """ Whether the objective includes the anchor term """
+    return self.anchor is not None and self.anchor_weight > 0
+
+  def build_key(self):
+    """ What the persistent problem depends on besides its parameters: its
+    shape, side constraints and anchor weight. The shape leaves room for
+    spare_blocks more server and spine blocks, whose cells are pinned to 0
+    by the bounds, so adding blocks only changes parameter values until
+    they outgrow it. """
+    weight = self.anchor_weight if self.anchored() else 0.0
+    shape = self.problem_key[0] if self.problem_key is not None else (0, 0)
+    if self.nsv > shape[0] or self.nsp > shape[1]:
+      shape = (self.nsv + self.spare_blocks, self.nsp + self.spare_blocks)
+    return (shape, tuple(self.side_constraints), weight)
+
+  @property
+  def problem_shape(self):
+    """ (server, spine) shape of the persistent problem's variables """
+    return self.problem_key[0]
+
+  def pad(self, values):
+    """ /values/ zero-padded to the problem shape along every axis """
+    values = np.asarray(values, dtype=float)
+    padded = np.zeros(self.problem_shape[:values.ndim])
+    padded[tuple(slice(0, n) for n in values.shape)] = values
+    return padded
+
+  def build_problem(self):
+    """ (Re)build the parameterized problem for its shape, see build_key """
+    self.problem_key = self.build_key()
+    self.prepare_variables()
+    self.prepare_parameters()
+    self.prepare_constraints()
+    self.prepare_objective()
+    self.problem = cp.Problem(cp.Minimize(self.objective), self.constraints)
+    return self.problem
+
+  def update_parameters(self):
+    """ Load current wiring and port counts into the problem parameters """
+    lower, upper = self.bounds()
+    self.wiring_param.value = self.pad(self.padded_wiring())
+    self.server_ports.value = self.pad(self.switch_set.server_numports)
+    self.spine_ports.value = np.zeros(self.problem_shape[1])
+    self.spine_ports.value[:self.nsp] = self.switch_set.spine_numports
+    self.lower.value = self.pad(lower)
+    self.upper.value = self.pad(upper)
+    if self.anchored():
+      self.anchor_param.value = self.pad(self.padded_wiring(self.anchor))
+
+  def prepare_parameters(self):
+    nsv, nsp = self.problem_shape
+    self.wiring_param = cp.Parameter((nsv, nsp))
+    self.server_ports = cp.Parameter(nsv)
+    self.spine_ports = cp.Parameter(nsp)
+    self.lower = cp.Parameter((nsv, nsp))
+    self.upper = cp.Parameter((nsv, nsp))
+    self.anchor_param = cp.Parameter((nsv, nsp))
 
   def prepare_variables(self): 
-    self.variables = cp.Variable(self.nsp*self.nsv*2, integer=True)
-    return self.variables
+    # x[i, j]: links between server block i and spine block j
+    # x_p[i, j]: absolute change in links from the current wiring
+    self.x = cp.Variable(self.problem_shape, integer=True)
+    self.x_p = cp.Variable(self.problem_shape, integer=True)
+    return self.x, self.x_p
+
+  @property
+  def variables(self):
+    """ Flat view of [x, x_p] following the `varidx` layout """
+    nsv, nsp = self.problem_shape
+    return cp.hstack([cp.reshape(self.x, (nsv*nsp,), order='C'),
+                      cp.reshape(self.x_p, (nsv*nsp,), order='C')])
 
   def varidx(self, _type, i, j):
+    nsv, nsp = self.problem_shape
     if _type == "x":
-      return i*self.nsp + j 
+      return i*nsp + j 
     else:
-      return self.nsp*self.nsv + i*self.nsp + j
+      return nsp*nsv + i*nsp + j
 
   def curr_wiring(self, i, j):
     if i >= self.current_wiring.shape[0] or j >= self.current_wiring.shape[1]:
@@ -100,117 +514,250 @@ class MinimalRewiringILP(object):
     else:
       return self.current_wiring[i][j]
 
+  def padded_wiring(self, wiring=None):
+    """ Current wiring, or /wiring/, zero-padded or cropped to the
+    (num_server, num_spine) shape """
+    source = self.current_wiring if wiring is None else np.asarray(wiring)
+    padded = np.zeros([self.nsv, self.nsp])
+    rows = min(self.nsv, source.shape[0])
+    cols = min(self.nsp, source.shape[1])
+    padded[:rows, :cols] = source[:rows, :cols]
+    return padded
+
+  def bounds(self):
+    """ Per-cell floor/ceil bounds of the even distribution constraints """
+    k = np.asarray(self.switch_set.server_numports, dtype=float) / float(self.nsp)
+    lower = np.repeat(np.floor(k)[:, None], self.nsp, axis=1)
+    upper = np.repeat(np.ceil(k)[:, None], self.nsp, axis=1)
+    return lower, upper
 
   def prepare_constraints(self):  
-    # non negative link counts
-    self.constraints = [self.variables[i] >=0 for i in range(self.nsp*self.nsv)]
-
-    # num of ports constraints [link conservation] 
-    for i in range(self.nsv):
-      self.constraints += [
-          np.ones(self.nsp)@self.variables[[self.varidx("x",i,j) for j in range(self.nsp)]] <= \
-          self.switch_set.server_numports[i]
-        ]
-
-    for j in range(self.nsp):
-      self.constraints += [
-          np.ones(self.nsv)@self.variables[[self.varidx("x",i,j) for i in range(self.nsv)]] <= \
-          self.switch_set.spine_numports[j]
-        ]
-
-    # capacity[even distribution] constraints  
-    for i in range(self.nsv):
-      k = self.switch_set.server_numports[i] / float(self.nsp)
-      self.constraints += [
-          self.variables[self.varidx("x",i,j)] >= np.floor(k) for j in range(self.nsp)
-        ]
-      self.constraints += [
-          self.variables[self.varidx("x",i,j)] <= np.ceil(k) for j in range(self.nsp) 
-        ]
-
-    # constraints to make optimization of absolute values of difference
-    for i in range(self.nsv):
-      for j in range(self.nsp):
-        self.constraints += [self.variables[self.varidx("x_p",i,j)] >= self.variables[self.varidx("x",i,j)] - self.curr_wiring(i,j) ]
-        self.constraints += [self.variables[self.varidx("x_p",i,j)] >= -1*(self.variables[self.varidx("x",i,j)] - self.curr_wiring(i,j)) ]
+    self.constraints = self.rewiring_constraints(self.x, self.x_p)
+
+  def rewiring_constraints(self, x, x_p):
+    """ Constraints of the problem over wiring /x/ and changes /x_p/ """
+    constraints = [
+        # non negative link counts
+        x >= 0,
+        # num of ports constraints [link conservation]
+        cp.sum(x, axis=1) <= self.server_ports,
+        cp.sum(x, axis=0) <= self.spine_ports,
+        # capacity[even distribution] constraints
+        x >= self.lower,
+        x <= self.upper,
+        # constraints to make optimization of absolute values of difference
+        x_p >= x - self.wiring_param,
+        x_p >= self.wiring_param - x,
+      ]
+    for side_constraint in self.side_constraints:
+      constraints += side_constraint(x)
+    return constraints
       
   def prepare_objective(self):
-    self.objective = 0
-    for i in range(2*self.nsv*self.nsp):
-      if i < self.nsv*self.nsp:
-        # try to utilize as much of the links as possible
-        self.objective -= self.variables[i]
-      else:
-        # minimize difference from initial wiring
-        self.objective += self.variables[i]
+    self.objective = self.objective_expr(self.x, self.x_p)
+
+  def objective_expr(self, x, x_p):
+    # try to utilize as much of the links as possible while minimizing
+    # difference from initial wiring
+    objective = cp.sum(x_p) - cp.sum(x)
+    if self.anchored():
+      # and from the anchor wiring, e.g. a later target of a roadmap
+      objective += self.anchor_weight * cp.sum(cp.abs(x - self.anchor_param))
+    return objective
+
+  def objective_value(self, wiring):
+    """ Objective of target /wiring/ for the current problem """
+    value = rewiring_objective(wiring, self.padded_wiring())
+    if self.anchored():
+      value += self.anchor_weight * np.abs(wiring - self.padded_wiring(self.anchor)).sum()
+    return value
 
   def link_moves(self, current_wiring, final_wiring):
-    capacity = self.switch_set.spine_numports
-    changes = self.connect_disconnect(current_wiring, final_wiring)
-    rewires = []
-    while len(changes) > 0:
-        actions, changes_p, new_capacity = self.swap(changes, capacity)
-        rewires += actions
-        changes = changes_p
-        capacity = new_capacity
-    return rewires
+    """ Sequence of single link instructions taking /current_wiring/ to
+    /final_wiring/ without ever exceeding the ports of a spine block
+
+    Links that only leave a spine block are disconnected first, links that
+    move between spine blocks of the same server block follow, and links
+    that are only added come last.
+
+    Returns:
+          rewires (list): ("DISCONNECT" or "CONNECT", server, spine) tuples
+
+    """
+    return list(self.iter_link_moves(current_wiring, final_wiring))
+
+  def iter_link_moves(self, current_wiring, final_wiring):
+    """ Generator version of link_moves, checking every instruction with
+    checked_plan as it is produced """
+    return self.checked_plan(current_wiring, 
+                             self.plan_link_moves(current_wiring, final_wiring))
+
+  def plan_link_moves(self, current_wiring, final_wiring):
+    moves, disconnects, connects = self.plan_changes(current_wiring, final_wiring)
+    spine_numports = np.round(self.switch_set.spine_numports).astype(int)
+    capacity = spine_numports - np.asarray(current_wiring).sum(axis=0).astype(int)
+
+    for s, p in disconnects:
+      capacity[p] += 1
+      yield ("DISCONNECT", s, p)
+    for action in self.iter_moves(moves, capacity):
+      yield action
+    for s, p in connects:
+      yield ("CONNECT", s, p)
+
+  def plan_changes(self, initial, final):
+    """ Split the difference between two wirings into per server block
+    moves between spine blocks, and leftover disconnects and connects
+
+    Returns:
+          moves (list): [server, from spine, to spine]
+          disconnects (list): (server, spine) links only removed
+          connects (list): (server, spine) links only added
+
+    """
+    diff = np.asarray(final).astype(int) - np.asarray(initial).astype(int)
+    cols = np.arange(diff.shape[1])
+    moves, disconnects, connects = [], [], []
+    for i in np.flatnonzero((diff != 0).any(axis=1)):
+      sources = np.repeat(cols, np.maximum(-diff[i], 0))
+      targets = np.repeat(cols, np.maximum(diff[i], 0))
+      n = min(len(sources), len(targets))
+      i = int(i)
+      moves += [[i, int(p0), int(p1)] for p0, p1 in zip(sources[:n], targets[:n])]
+      disconnects += [(i, int(p)) for p in sources[n:]]
+      connects += [(i, int(p)) for p in targets[n:]]
+    return moves, disconnects, connects
 
   def connect_disconnect(self, initial, final):
-    disconnect = []
-    connect = []
-    log = []
-    for i in range(len(initial)):
-        for j in range(len(initial[0])): 
-            to_change = final[i][j] - initial[i][j]
-            if to_change < 0:  
-                # check if there's a match if not store away
-                for k in range(len(connect)): 
-                    if connect[k][0] == i:
-                        while connect[k][2] and abs(to_change):
-                            connect[k][2] -= 1
-                            to_change += 1
-                            log.append([i, connect[k][1], i, j]) 
-                    if not abs(to_change):
-                        break
-                if abs(to_change):
-                    disconnect.append([i, j, to_change]) 
-            elif to_change > 0:
-                for k in range(len(disconnect)): 
-                    if disconnect[k][0] == i:
-                        while abs(disconnect[k][2]) and to_change:
-                            disconnect[k][2] += 1
-                            to_change -= 1
-                            log.append([i, disconnect[k][1], i, j]) 
-                    if not abs(to_change):
-                        break 
-                if abs(to_change):
-                    connect.append([i, j, to_change])      
-    return log
- 
-  def link_change_at(self, p, changes):
-      print(p, changes)
-      for i in range(len(changes)):
-          if changes[i][1] == p:
-              return changes[i], changes[:i]+changes[i+1:]
-      print("No link to move from this spine block!")
-
-  def swap(self, changes, capacity):
-      actions = []
-      s0, p0, _s1, p1 = changes.pop(0)
-      actions.append(("DISCONNECT", s0, p0))
-      if capacity[p1] == 0 and len(changes):
-          tmp = self.link_change_at(p1, changes) 
-          s2, p2, _s3, p3 = tmp[0]
-          changes_p = tmp[1]
-          actions.append(("DISCONNECT", s2, p2))
-          actions.append(("CONNECT", s2, p0))
-          changes = [(s2, p0, s2, p3)] + changes_p
-      elif len(changes):
-          capacity[p1] -= 1
-          capacity[p0] += 1
-      actions.append(("CONNECT", s0, p1))
-      return actions, changes, capacity 
-    
-                
+    """ Moves of links between spine blocks as [server, from, server, to] """
+    moves, _, _ = self.plan_changes(initial, final)
+    return [[s, p0, s, p1] for s, p0, p1 in moves]
+
+  def schedule_moves(self, moves, capacity):
+    """ Order link moves so that no spine block runs out of ports. When the
+    target of a move is full, a pending move out of that target is chained
+    through the port just freed at the source.
+
+    Args:
+          moves (list): [server, from spine, to spine] moves
+          capacity (np.ndarray): free ports of every spine block, updated
+
+    Returns:
+          actions (list): ("DISCONNECT" or "CONNECT", server, spine) tuples
+
+    """
+    return list(self.iter_moves(moves, capacity))
+
+  def iter_moves(self, moves, capacity):
+    """ Generator version of schedule_moves """
+    moves = [list(m) for m in moves]
+    alive = [True] * len(moves)
+    queue = deque(range(len(moves)))
+    by_src = defaultdict(deque)           # spine -> pending moves out of it
+    for m, (_s, p0, _p1) in enumerate(moves):
+      by_src[p0].append(m)
 
+    while queue:
+      m = queue.popleft()
+      if not alive[m]:
+        continue
+      alive[m] = False
+      s0, p0, p1 = moves[m]
+      capacity[p0] += 1
+      yield ("DISCONNECT", s0, p0)
+
+      if capacity[p1] <= 0:
+        pending = by_src[p1]
+        while pending and not alive[pending[0]]:
+          pending.popleft()
+        if not pending:
+          raise Exception("No link to move from spine block {}.".format(p1))
+        m2 = pending.popleft()
+        alive[m2] = False
+        s2, _p1, p3 = moves[m2]
+        capacity[p1] += 1
+        capacity[p0] -= 1
+        yield ("DISCONNECT", s2, p1)
+        yield ("CONNECT", s2, p0)
+        if p3 != p0:
+          # the chained link still has to reach its own target
+          moves.append([s2, p0, p3])
+          alive.append(True)
+          queue.appendleft(len(moves) - 1)
+          by_src[p0].append(len(moves) - 1)
+      capacity[p1] -= 1
+      yield ("CONNECT", s0, p1)
+
+  def check_plan(self, current_wiring, rewires):
+    """ Check that applying /rewires/ to /current_wiring/ never removes a
+    missing link nor exceeds the ports of a spine block """
+    for _ in self.checked_plan(current_wiring, rewires):
+      pass
+
+  def checked_plan(self, current_wiring, rewires):
+    """ Pass through the instructions of /rewires/, raising as soon as one
+    would remove a missing link or exceed the ports of a spine block """
+    wiring = np.array(current_wiring, dtype=int)
+    used = wiring.sum(axis=0)
+    spine_numports = np.round(self.switch_set.spine_numports).astype(int)
+    for step, (action, s, p) in enumerate(rewires):
+      if action == "CONNECT":
+        wiring[s, p] += 1
+        used[p] += 1
+        if used[p] > spine_numports[p]:
+          raise Exception("Step {} exceeds the {} ports of spine block {}."
+                          .format(step, spine_numports[p], p))
+      else:
+        wiring[s, p] -= 1
+        used[p] -= 1
+        if wiring[s, p] < 0:
+          raise Exception("Step {} removes a missing link between server "
+                          "block {} and spine block {}.".format(step, s, p))
+      yield (action, s, p)
+
+
+def cross_check_backends(trials=20, max_blocks=6, max_links=4, seed=0):
+  """ Check that the ILP and flow backends reach the same objective on
+  random wiring matrices
+
+  Args:
+        trials (int): number of random instances
+        max_blocks (int): largest number of server or spine blocks
+        max_links (int): largest number of links between a pair of blocks
+        seed (int): seed of the random instances
+
+  Returns:
+        objectives (list): (ilp, flow) objective for every instance
+
+  """
+  rng = np.random.RandomState(seed)
+  objectives = []
+  for _ in range(trials):
+    shape = rng.randint(1, max_blocks + 1, size=2)
+    wiring = rng.randint(0, max_links + 1, size=shape)
+    level = "spine" if rng.rand() < 0.5 else "server"
+    num_ports = rng.randint(1, max_links * max_blocks + 1)
 
+    results = []
+    for backend in ("ilp", "flow"):
+      minwiring = MinimalRewiringILP(wiring.copy(), backend=backend)
+      minwiring.add_block(level, num_ports)
+      minwiring.nsp = minwiring.switch_set.num_spine
+      minwiring.nsv = minwiring.switch_set.num_server
+      try:
+        target = minwiring.solve()
+      except InfeasibleRewiring:
+        # infeasible instance, both backends have to agree on it
+        results.append(None)
+        continue
+      results.append(rewiring_objective(target, minwiring.padded_wiring()))
+    if None in results:
+      if results != [None, None]:
+        raise Exception("Backends disagree on feasibility of {}."
+                        .format(wiring.tolist()))
+      continue
+    if abs(results[0] - results[1]) > 1e-6:
+      raise Exception("Backends disagree on {}: ilp {} vs flow {}."
+                      .format(wiring.tolist(), *results))
+    objectives.append(tuple(results))
+  return objectives
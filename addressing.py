@@ -0,0 +1,109 @@
+import numpy as np
+
+
+class AddressPlan(object):
+  """ Prefix-aligned IPv4 addresses for the hosts of a network
+
+  Host addresses are laid out as base | pod | edge | host bit fields, so
+  that every edge switch and every pod (edges linked to the same aggs, see
+  Network.route_index) owns a prefix. Field widths fit the largest pod and
+  edge of the network, host numbers start at 1.
+
+  Args:
+        network (Network): network whose hosts are addressed
+        base (int): network address of the plan, 10.0.0.0 by default
+        base_len (int): prefix length of /base/
+
+  """
+  def __init__(self, network, base=10 << 24, base_len=8):
+    self.base = base
+    self.base_len = base_len
+    self.address = {}                     # address[host nid] = int address
+    self.edge_prefix = {}                 # edge_prefix[edge nid] = (prefix, len)
+    self.pod_prefix = {}                  # pod_prefix[pod] = (prefix, len)
+
+    ctx = network.route_index()
+    # unattached hosts share one spare edge in one spare pod
+    pods = np.where(ctx['pod'] >= 0, ctx['pod'], len(ctx['pod_aggs']))
+    edges = {}
+    for h_id, e_id, pod in zip(ctx['hosts'].tolist(), ctx['edge'].tolist(), pods.tolist()):
+      edges.setdefault(pod, {}).setdefault(e_id, []).append(h_id)
+
+    pod_bits = bit_length(len(edges) - 1)
+    edge_bits = bit_length(max([len(e) for e in edges.values()] or [1]) - 1)
+    host_bits = bit_length(max([len(h) for e in edges.values() for h in e.values()] or [0]))
+    self.bits = (pod_bits, edge_bits, host_bits)
+    if base_len + sum(self.bits) > 32:
+      raise ValueError("Address plan needs {} host bits, only {} available."
+                       .format(sum(self.bits), 32 - base_len))
+
+    edge_len = base_len + pod_bits + edge_bits
+    for p, pod in enumerate(sorted(edges)):
+      prefix = base | (p << (edge_bits + host_bits))
+      self.pod_prefix[pod] = (prefix, base_len + pod_bits)
+      for e, e_id in enumerate(sorted(edges[pod])):
+        e_prefix = prefix | (e << host_bits)
+        if e_id >= 0:
+          self.edge_prefix[e_id] = (e_prefix, edge_len)
+        for n, h_id in enumerate(sorted(edges[pod][e_id])):
+          self.address[h_id] = e_prefix | (n + 1)
+
+  def ip(self, h_id):
+    """ Dotted quad address of host /h_id/ """
+    return to_dotted(self.address[h_id])
+
+  def aggregate(self, routes):
+    """ Route entries (prefix, masklen, port) of a {host: port} table, see
+    aggregate_routes """
+    return aggregate_routes(routes, self.address, self.base, self.base_len)
+
+
+def bit_length(n):
+  return int(n).bit_length() if n > 0 else 0
+
+
+def to_dotted(address):
+  return '.'.join(str((address >> shift) & 255) for shift in (24, 16, 8, 0))
+
+
+def aggregate_routes(routes, address, base=0, base_len=0):
+  """ Fewest disjoint prefixes covering the routes of a switch
+
+  Walks the binary trie of host addresses below /base/ and emits the
+  largest subtrees whose hosts all leave through the same port. Hosts
+  without a route are never covered, so aggregated entries match exactly
+  the traffic the per-host entries would, and entries never overlap.
+
+  Args:
+        routes (dict): host id -> out port
+        address (dict): host id -> int address, for every host
+        base (int): prefix every address falls under
+        base_len (int): length of /base/, the shortest prefix emitted
+
+  Returns:
+        entries (list): (prefix, masklen, port) tuples sorted by prefix
+
+  """
+  hosts = list(address)
+  addrs = np.array([address[h_id] for h_id in hosts], dtype=np.int64)
+  ports = np.array([routes.get(h_id, -1) for h_id in hosts], dtype=np.int64)
+  order = np.argsort(addrs, kind='stable')
+  addrs, ports = addrs[order], ports[order]
+
+  entries = []
+  stack = [(base, base_len, 0, len(addrs))]
+  while stack:
+    prefix, masklen, lo, hi = stack.pop()
+    if lo == hi:
+      continue
+    first = ports[lo]
+    if (ports[lo:hi] == first).all():
+      if first >= 0:
+        entries.append((prefix, masklen, int(first)))
+      continue
+    # split on the next address bit
+    bit = 1 << (31 - masklen)
+    mid = lo + np.searchsorted(addrs[lo:hi], prefix | bit)
+    stack.append((prefix, masklen + 1, lo, mid))
+    stack.append((prefix | bit, masklen + 1, mid, hi))
+  return sorted(entries)
@@ -0,0 +1,5 @@
+""" Benchmarks of rewiring and routing on synthetic Clos fabrics
+
+    python -m benchmarks.run --sizes 4 8 16 --output new.json
+    python -m benchmarks.compare old.json new.json
+"""
@@ -0,0 +1,106 @@
+import numpy as np
+from network import Network, CompactNetwork
+
+
+def even_wiring(agg_uplinks, num_cores):
+  """ Agg:core wiring matrix satisfying the floor/ceil even distribution
+  of MinimalRewiringILP, with the extra links rotated over cores so that
+  core port usage stays balanced
+
+  Args:
+        agg_uplinks (list): number of uplinks of every agg
+        num_cores (int): number of cores
+
+  Returns:
+        wiring (np.ndarray): links between every agg and core
+
+  """
+  wiring = np.zeros((len(agg_uplinks), num_cores), dtype=int)
+  offset = 0
+  for i, uplinks in enumerate(agg_uplinks):
+    wiring[i, :] = uplinks // num_cores
+    extra = uplinks % num_cores
+    wiring[i, (offset + np.arange(extra)) % num_cores] += 1
+    offset += extra
+  return wiring
+
+
+def clos_network(pods, edges_per_pod, aggs_per_pod, hosts_per_edge, num_cores,
+                 agg_uplinks=None, core_ports=None, compact=False):
+  """ Three tier Clos network, optionally with heterogeneous agg uplinks
+
+  Switch ids are assigned per tier: hosts, edges, aggs then cores. Every
+  edge links once to every agg of its pod.
+
+  Args:
+        pods (int): number of pods
+        edges_per_pod (int): edge switches per pod
+        aggs_per_pod (int): agg switches per pod
+        hosts_per_edge (int): hosts per edge switch
+        num_cores (int): number of core switches
+        agg_uplinks (int or list): uplinks of every agg, defaults to
+          edges_per_pod
+        core_ports (int): ports per core, defaults to the most used
+        compact (bool): build a CompactNetwork instead of a Network
+
+  Returns:
+        net (Network): the network
+        wiring (np.ndarray): agg:core wiring matrix
+
+  """
+  num_aggs = pods * aggs_per_pod
+  if agg_uplinks is None:
+    agg_uplinks = edges_per_pod
+  if np.isscalar(agg_uplinks):
+    agg_uplinks = [agg_uplinks] * num_aggs
+  wiring = even_wiring(agg_uplinks, num_cores)
+  if core_ports is None:
+    core_ports = int(wiring.sum(axis=0).max())
+
+  net = CompactNetwork() if compact else Network()
+  sid = 1
+  hosts, edges, aggs, cores = [], [], [], []
+  for _ in range(pods * edges_per_pod * hosts_per_edge):
+    net.add_switch(sid, 1, 'host')
+    hosts.append(sid)
+    sid += 1
+  for _ in range(pods * edges_per_pod):
+    net.add_switch(sid, hosts_per_edge + aggs_per_pod, 'edge')
+    edges.append(sid)
+    sid += 1
+  for i in range(num_aggs):
+    net.add_switch(sid, edges_per_pod + int(agg_uplinks[i]), 'agg')
+    aggs.append(sid)
+    sid += 1
+  for _ in range(num_cores):
+    net.add_switch(sid, core_ports, 'core')
+    cores.append(sid)
+    sid += 1
+
+  for i, h_id in enumerate(hosts):
+    net.add_link(h_id, edges[i // hosts_per_edge], 1)
+  for i, e_id in enumerate(edges):
+    pod = i // edges_per_pod
+    for a_id in aggs[pod * aggs_per_pod:(pod + 1) * aggs_per_pod]:
+      net.add_link(e_id, a_id, 1)
+  for i, j in zip(*np.nonzero(wiring)):
+    net.add_link(aggs[i], cores[j], int(wiring[i, j]))
+
+  return net, wiring
+
+
+def fat_tree(k, compact=False):
+  """ k-ary fat tree: k pods of k/2 edges and k/2 aggs, k/2 hosts per edge
+  and (k/2)^2 cores """
+  half = k // 2
+  return clos_network(k, half, half, half, half * half, compact=compact)
+
+
+def heterogeneous_clos(pods, num_cores, min_uplinks, max_uplinks, seed=0,
+                       compact=False):
+  """ Clos network with 2 edges and 2 aggs per pod whose aggs have a random
+  number of uplinks in [min_uplinks, max_uplinks] """
+  rng = np.random.RandomState(seed)
+  uplinks = rng.randint(min_uplinks, max_uplinks + 1, size=2 * pods)
+  return clos_network(pods, 2, 2, 2, num_cores, agg_uplinks=uplinks,
+                      compact=compact)
@@ -0,0 +1,50 @@
+import argparse, json, sys
+
+
+def compare(old, new, threshold=1.25, min_seconds=1e-3):
+  """ Compare two benchmark result files phase by phase
+
+  Args:
+        old (dict): baseline results, as written by benchmarks.run
+        new (dict): results to check
+        threshold (float): slowdown ratio counted as a regression
+        min_seconds (float): timings below this are too noisy to compare
+
+  Returns:
+        rows (list): (k, phase, old seconds, new seconds, ratio, regressed)
+
+  """
+  baseline = {(r['k'], r['phase']): r for r in old['results']}
+  rows = []
+  for rec in new['results']:
+    ref = baseline.get((rec['k'], rec['phase']))
+    if ref is None:
+      continue
+    ratio = rec['seconds'] / max(ref['seconds'], 1e-12)
+    regressed = ratio > threshold and rec['seconds'] > min_seconds
+    rows.append((rec['k'], rec['phase'], ref['seconds'], rec['seconds'], 
+                 ratio, regressed))
+  return rows
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Compare benchmark results')
+  parser.add_argument('old')
+  parser.add_argument('new')
+  parser.add_argument('--threshold', type=float, default=1.25)
+  args = parser.parse_args(argv)
+
+  with open(args.old) as fp:
+    old = json.load(fp)
+  with open(args.new) as fp:
+    new = json.load(fp)
+
+  rows = compare(old, new, args.threshold)
+  for k, phase, before, after, ratio, regressed in rows:
+    print("k={:<4} {:<16} {:10.4f}s -> {:10.4f}s  x{:.2f}{}".format(
+          k, phase, before, after, ratio, "  REGRESSION" if regressed else ""))
+  return 1 if any(row[-1] for row in rows) else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
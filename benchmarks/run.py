@@ -0,0 +1,128 @@
+import argparse, json, platform, subprocess, time, tracemalloc
+import numpy as np
+from ILP import MinimalRewiringILP
+from benchmarks.clos import fat_tree
+
+PHASES = ('build', 'core_agg_wiring', 'route_ecmp', 'ilp_build', 'ilp_solve',
+          'flow_solve', 'link_moves')
+
+
+def measure(func, *args, **kwargs):
+  """ Run func(*args), returning its result, seconds and peak traced bytes.
+  Tracing slows the run down, so seconds are only meaningful untraced and
+  the peak is None then.
+
+  Args:
+        traced (bool): trace allocations, keyword only
+
+  """
+  traced = kwargs.pop('traced', False)
+  if traced:
+    tracemalloc.start()
+  start = time.perf_counter()
+  result = func(*args)
+  seconds = time.perf_counter() - start
+  peak = None
+  if traced:
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+  return result, seconds, peak
+
+
+def preload():
+  """ Import the modules the solvers load on first use, so the first size
+  timed does not pay for them """
+  import cvxpy, networkx
+  return cvxpy, networkx
+
+
+def git_version():
+  try:
+    return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                   stderr=subprocess.DEVNULL).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def bench_size(k, phases, compact=False):
+  """ Time every phase of one expansion of a k-ary fat tree by a spine,
+  then measure peak memory in a second, traced run """
+  timed = run_phases(k, phases, compact, traced=False)
+  traced = run_phases(k, phases, compact, traced=True)
+  return [dict(rec, peak_bytes=peak['peak_bytes'])
+          for rec, peak in zip(timed, traced)]
+
+
+def run_phases(k, phases, compact=False, traced=False):
+  """ One expansion of a k-ary fat tree by a spine, measuring every phase
+  with measure """
+  timings = {}
+
+  def record(phase, func, *args):
+    result, seconds, peak = measure(func, *args, traced=traced)
+    timings[phase] = (seconds, peak)
+    return result
+
+  net, wiring = record('build', fat_tree, k, compact)
+  if 'core_agg_wiring' in phases:
+    record('core_agg_wiring', net.core_agg_wiring)
+  if 'route_ecmp' in phases:
+    record('route_ecmp', net.route_ecmp, 0)
+
+  minwiring = MinimalRewiringILP(wiring)
+  minwiring.add_block('spine', int(wiring.sum(axis=0).max()))
+  minwiring.nsp = minwiring.switch_set.num_spine
+  minwiring.nsv = minwiring.switch_set.num_server
+  old_wiring = minwiring.padded_wiring().astype(int)
+
+  new_wiring = None
+  if 'ilp_build' in phases or 'ilp_solve' in phases:
+    record('ilp_build', minwiring.build_problem)
+    new_wiring = record('ilp_solve', minwiring.solve_ilp)
+  if 'flow_solve' in phases or new_wiring is None:
+    new_wiring = record('flow_solve', minwiring.solve_flow)
+  if 'link_moves' in phases:
+    record('link_moves', minwiring.link_moves, old_wiring, new_wiring)
+
+  size = {'k': k, 'hosts': len(net.get_type('host')),
+          'switches': len(net.switches), 'links': int(wiring.sum())}
+  return [dict(size, phase=phase, seconds=seconds, peak_bytes=peak)
+          for phase, (seconds, peak) in timings.items() if phase in phases]
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--sizes', type=int, nargs='+', default=[4, 8, 12, 16],
+                      help='fat tree arities to benchmark')
+  parser.add_argument('--phases', nargs='+', default=list(PHASES),
+                      choices=PHASES)
+  parser.add_argument('--repeat', type=int, default=1,
+                      help='runs per size, the fastest is kept')
+  parser.add_argument('--compact', action='store_true',
+                      help='use CompactNetwork storage')
+  parser.add_argument('--output', help='write JSON results to this file')
+  args = parser.parse_args(argv)
+
+  preload()
+  records = {}
+  for k in args.sizes:
+    for _ in range(args.repeat):
+      for rec in bench_size(k, args.phases, args.compact):
+        key = (rec['k'], rec['phase'])
+        if key not in records or rec['seconds'] < records[key]['seconds']:
+          records[key] = rec
+      
+  results = {'version': git_version(), 'python': platform.python_version(),
+             'numpy': np.__version__, 'compact': args.compact,
+             'timestamp': time.time(), 'results': list(records.values())}
+
+  for rec in results['results']:
+    print("k={k:<4} {phase:<16} {seconds:10.4f}s {peak_bytes:>14,d}B".format(**rec))
+  if args.output:
+    with open(args.output, 'w') as fp:
+      json.dump(results, fp, indent=2)
+  return results
+
+
+if __name__ == '__main__':
+  main()
@@ -1,15 +1,28 @@
 from ryu.base import app_manager
 from ryu.controller import ofp_event, dpset
-from ryu.controller.handler import MAIN_DISPATCHER, CONFIG_DISPATCHER
+from ryu.controller.handler import MAIN_DISPATCHER
 from ryu.controller.handler import set_ev_cls
-from ryu.lib.ip import ipv4_to_bin
-from ryu.lib.packet import packet     
-import random, math, json, sys
-from time import sleep
-from ILP import MinimalRewiringILP
+from collections import defaultdict
+from ryu.lib import hub
+import os, sys
 from network import Network
-from mininet.net import Mininet
-from mininet.topo import Topo
+from addressing import AddressPlan
+from instrument import NULL
+from pacing import Pacer
+from simulate import CapacitySimulator
+
+# snapshot (see Network.save_snapshot) to start from instead of the sample
+# network, written on first start if missing
+SNAPSHOT_ENV = 'MINIMAL_REWIRING_SNAPSHOT'
+# set to 1 to install prefix routes instead of host routes
+AGGREGATE_ENV = 'MINIMAL_REWIRING_AGGREGATE'
+# set to 1 to route with WCMP, see Network.route_ecmp
+WEIGHTED_ENV = 'MINIMAL_REWIRING_WCMP'
+
+
+def env_flag(name):
+  """ Whether environment variable /name/ is set to anything but 0 """
+  return os.environ.get(name, '0') not in ('', '0')
 
 
 class Controller(app_manager.RyuApp):
@@ -17,36 +30,98 @@ class Controller(app_manager.RyuApp):
     super(Controller, self).__init__()
 
     self.switches = {}      # Switches 
-    self.num_switches = -1  # track that all switches have reported
-    self.priority = 1100    # current max priority 
+    self.expected = set()   # switch ids whose datapaths must connect
+    self.ready = hub.Event()  # set once every expected switch connected
+    self.ready_timeout = 30 # seconds to wait for switches before expanding
+    self.priority = 1100    # priority of installed routes
+    self.installed = defaultdict(dict)  # installed[s_id] = {(dst, masklen): port}
+    self.inflight = 0       # FlowMods sent and not yet acknowledged
+    self.barriers = {}      # (datapath id, barrier xid) -> FlowMods it acknowledges
     self.numH = None        # number of hosts  
     self.verbose = 0        # reporting details 
+    self.instrument = NULL  # phase timings and counters of expansions
+    self.aggregate = env_flag(AGGREGATE_ENV)  # prefix routes, not host routes
+    self.address = None     # AddressPlan of hosts when aggregating
+    self.weighted = env_flag(WEIGHTED_ENV)  # WCMP routes by rewired capacity
 
-    self.network = self.initial_network1()
-    self.mininet_from_network(self.network)
+    self.minwiring = None   # MinimalRewiringILP, see rewiring
+
+    self.network = self.load_network()
+    if self.aggregate:
+      self.address = AddressPlan(self.network)
+    if self.aggregate or self.weighted:
+      # pod granularity routes whole pods alike, so they share prefixes
+      self.network.route_ecmp(granularity='pod' if self.aggregate else None,
+                              mode='wcmp' if self.weighted else None)
     self.wiring, self.agg_key, self.core_key = self.network.core_agg_wiring()
-    self.minwiring = MinimalRewiringILP(self.wiring)
-    # wait a few secs and add new switch
-    sleep(10)
+    self.expected = set(sid for stype in ('edge', 'agg', 'core')
+                        for sid in self.network.get_type(stype))
+    hub.spawn(self.startup)
+
+  def load_network(self):
+    """ Initial network, from the snapshot named by $MINIMAL_REWIRING_SNAPSHOT
+    if set, else the sample network (then saved to that snapshot) """
+    path = os.environ.get(SNAPSHOT_ENV)
+    if path and os.path.exists(path):
+      return Network.load_snapshot(path)
+    network = self.initial_network1()
+    if path:
+      network.route_ecmp()
+      network.save_snapshot(path)
+    return network
+
+  def startup(self):
+    """ Bring up the emulated topology and expand once every switch of the
+    network has connected, or after ready_timeout seconds """
+    self.mininet_from_network(self.network)
+    if not self.ready.wait(timeout=self.ready_timeout):
+      self.logger.warning("Expanding with %d of %d switches connected",
+                          len(self.expected & set(self.switches)), len(self.expected))
     self.add_switch('spine', 5,2) 
 
+  def rewiring(self):
+    """ MinimalRewiringILP of the initial wiring, created on first use """
+    if self.minwiring is None:
+      from ILP import MinimalRewiringILP
+      self.minwiring = MinimalRewiringILP(self.wiring, instrument=self.instrument)
+    return self.minwiring
+
   def mininet_from_network(self, network):
-    """ Generate a mininet topology corresponding to the /network/ """
+    """ Generate and start a mininet topology corresponding to the /network/ """
+    from mininet.net import Mininet
+    from mininet.node import RemoteController
+    from mininet.topo import Topo
     self.topo = Topo()
 
     hosts = self.network.get_type('host')
     for sid in hosts:
-      self.topo.addHost('s%d' % sid, dpid=("%0.2X" % sid))
+      if self.address is not None:
+        ip = '%s/%d' % (self.address.ip(sid), self.address.base_len)
+        self.topo.addHost('s%d' % sid, dpid=("%0.2X" % sid), ip=ip)
+      else:
+        self.topo.addHost('s%d' % sid, dpid=("%0.2X" % sid))
     for sid in self.network.switches.keys():
       if sid not in hosts:
         self.topo.addSwitch('s%d' % sid, dpid=("%0.2X" % sid), 
                             protocols='OpenFlow10')
 
-    for sid1, sid2 in self.network.edges.keys():
-      self.addLink('s%d' % sid1, 's%d' % sid2)
+    for (sid1, sid2), _count in self.network.link_counts():
+      for port1, port2 in zip(self.network.link_ports(sid1, sid2),
+                              self.network.link_ports(sid2, sid1)):
+        # switch ends take the ports routes are computed for, hosts keep
+        # mininet's interface numbering
+        ports = {}
+        if sid1 not in hosts:
+          ports['port1'] = port1
+        if sid2 not in hosts:
+          ports['port2'] = port2
+        self.topo.addLink('s%d' % sid1, 's%d' % sid2, **ports)
 
-    self.mininet = Mininet(self.topo)
-    self.mininet.pingAll(timeout=1)
+    self.mininet = Mininet(self.topo, build=False)
+    self.mininet.addController('c0', controller=RemoteController)
+    self.mininet.start()
+    if self.verbose:
+      self.mininet.pingAll(timeout=1)
 
     return self.mininet
 
@@ -54,45 +129,120 @@ class Controller(app_manager.RyuApp):
   def switchStatus(self, ev): 
     print("S %s: %s!" % (ev.dp.id, "connected" if ev.enter else "disconnected"))
     sys.stdout.flush()
-    self.prepareSwitch(ev.dp)
+    if ev.enter:
+      self.prepareSwitch(ev.dp)
+    else:
+      # resynced in full if it reconnects, its barriers will never be
+      # answered
+      self.switches.pop(int(ev.dp.id), None)
+      self.installed.pop(int(ev.dp.id), None)
+      for key in [key for key in self.barriers if key[0] == ev.dp.id]:
+        self.inflight -= self.barriers.pop(key)
+
+  @set_ev_cls(ofp_event.EventOFPBarrierReply, MAIN_DISPATCHER)
+  def barrierReply(self, ev):
+    self.inflight -= self.barriers.pop((ev.msg.datapath.id, ev.msg.xid), 0)
 
   def prepareSwitch(self, sw):
     hostIp = int(sw.id)  
     self.switches[hostIp] = sw
-
-    routes = self.network.route_ecmp()
-    self.priority += 1
-    for s_id in routes.keys():
-      for h_id in routes[s_id].keys():
-        self.install_flow(self.switches[s_id], 
-                          (10 << 24) + h_id, routes[s_id][h_id], 
-                          pr=self.priority)
+    self.reroute(extra=[hostIp])
+    if self.expected <= set(self.switches):
+      self.ready.set()
 
   def install_flow(self, sw, dst, out, pr=1100, src=None): 
     # Send the ARP/IP packets to the proper host
+    for mod in self.flow_mods(sw, dst, out, sw.ofproto.OFPFC_ADD, pr, src):
+      sw.send_msg(mod)
+
+  def flow_mods(self, sw, dst, out, command, pr=1100, src=None, masklen=32):
+    """ ARP and IP FlowMods applying /command/ to the route towards /dst/,
+    a prefix of /masklen/ bits """
     ofproto = sw.ofproto
-    action = sw.ofproto_parser.OFPActionOutput(out)
+    actions = [sw.ofproto_parser.OFPActionOutput(out)] if out is not None else []
     if not src:
-      match = sw.ofproto_parser.OFPMatch(dl_type=0x806, nw_dst=dst) 
-      match_arp = sw.ofproto_parser.OFPMatch(dl_type=0x800, nw_dst=dst) 
+      match = sw.ofproto_parser.OFPMatch(dl_type=0x806, nw_dst=dst, 
+                                         nw_dst_mask=masklen) 
+      match_arp = sw.ofproto_parser.OFPMatch(dl_type=0x800, nw_dst=dst, 
+                                             nw_dst_mask=masklen) 
     else:
-      match = sw.ofproto_parser.OFPMatch(dl_type=0x806, nw_dst=dst, nw_src=src) 
-      match_arp = sw.ofproto_parser.OFPMatch(dl_type=0x800, nw_dst=dst, nw_src=src)
-    mod = sw.ofproto_parser.OFPFlowMod(
-            datapath=sw, match=match, cookie=0,
-            command=ofproto.OFPFC_ADD, idle_timeout=0, hard_timeout=0,
-            priority=pr,
-            flags=ofproto.OFPFF_SEND_FLOW_REM, 
-            actions=[action])
-    sw.send_msg(mod)
-
-    mod = sw.ofproto_parser.OFPFlowMod(
-            datapath=sw, match=match_arp, cookie=0,
-            command=ofproto.OFPFC_ADD, idle_timeout=0, hard_timeout=0,
-            priority=pr,
-            flags=ofproto.OFPFF_SEND_FLOW_REM, 
-            actions=[action])
-    sw.send_msg(mod)
+      match = sw.ofproto_parser.OFPMatch(dl_type=0x806, nw_dst=dst, nw_src=src,
+                                         nw_dst_mask=masklen) 
+      match_arp = sw.ofproto_parser.OFPMatch(dl_type=0x800, nw_dst=dst, nw_src=src,
+                                             nw_dst_mask=masklen)
+    return [sw.ofproto_parser.OFPFlowMod(
+              datapath=sw, match=m, cookie=0,
+              command=command, idle_timeout=0, hard_timeout=0,
+              priority=pr,
+              flags=ofproto.OFPFF_SEND_FLOW_REM, 
+              actions=actions) for m in (match, match_arp)]
+
+  def flow_entries(self, s_id):
+    """ Flow table of switch /s_id/ as {(dst, masklen): port}: one entry
+    per host, or disjoint prefixes when aggregating """
+    routes = self.network.routes.get(s_id, {})
+    if self.address is None:
+      return {((10 << 24) + h_id, 32): port for h_id, port in routes.items()}
+    return {(prefix, masklen): port 
+            for prefix, masklen, port in self.address.aggregate(routes)}
+
+  def sync_routes(self, s_ids):
+    """ Bring the flow tables of switches /s_ids/ in line with the current
+    routes, sending FlowMods only for entries that changed. Messages are
+    batched per datapath and closed with a barrier.
+
+    Returns:
+          stats (dict): FlowMods 'sent', 'saved' against reinstalling every
+            route, and 'barriers' sent
+
+    """
+    stats = {'sent': 0, 'saved': 0, 'barriers': 0}
+    for s_id in s_ids:
+      sw = self.switches.get(s_id)
+      if sw is None:
+        # not connected yet, synced in full once it is
+        continue
+      ofproto = sw.ofproto
+      entries = self.flow_entries(s_id)
+      installed = self.installed[s_id]
+
+      # longer prefixes take priority while old and new prefixes overlap,
+      # and deletions go last so no destination is left unmatched
+      batch, deletes = [], []
+      for key in set(entries) | set(installed):
+        old, new = installed.get(key), entries.get(key)
+        if old == new:
+          continue
+        dst, masklen = key
+        pr = self.priority - (32 - masklen)
+        if new is None:
+          del installed[key]
+          deletes += self.flow_mods(sw, dst, new, ofproto.OFPFC_DELETE_STRICT,
+                                    pr=pr, masklen=masklen)
+        else:
+          command = ofproto.OFPFC_ADD if old is None else ofproto.OFPFC_MODIFY_STRICT
+          installed[key] = new
+          batch += self.flow_mods(sw, dst, new, command, pr=pr, masklen=masklen)
+      batch += deletes
+
+      stats['saved'] += 2 * len(entries) - len(batch)
+      if not batch:
+        continue
+      for mod in batch:
+        sw.send_msg(mod)
+      barrier = sw.ofproto_parser.OFPBarrierRequest(sw)
+      sw.set_xid(barrier)
+      self.barriers[(sw.id, barrier.xid)] = len(batch)
+      self.inflight += len(batch)
+      sw.send_msg(barrier)
+      stats['sent'] += len(batch)
+      stats['barriers'] += 1
+
+    self.logger.info("Rerouting sent %d FlowMods, saved %d", 
+                     stats['sent'], stats['saved'])
+    self.instrument.count('flowmods_sent', stats['sent'])
+    self.instrument.count('flowmods_saved', stats['saved'])
+    return stats
 
   def add_switch(self, level, nports, pace=2):
     """ Add spine or server block switch with /nports/ complete with all 
@@ -104,51 +254,221 @@ class Controller(app_manager.RyuApp):
           pace (int): number of instructions to install before rerouting
 
     """
-    self.network.max_sid += 1 
-    sid = self.network.max_sid 
-    self.mininet.addSwitch('s%d' % sid, dpid=("%0.2X" % sid), 
-                            protocols='OpenFlow10')
-    if level == 'spine':
-      stype = 'core'
-      self.core_key[len(self.core_key)] = sid
-    else: 
-      stype = 'agg'
-      self.agg_key[len(self.agg_key)] = sid
-
-    self.network.add_switch(sid, nports, stype)
-
-    instructions = self.minwiring.rewire(level, nports)
-    for i, instr in enumerate(instructions):
-      # add or delete link from network state and mininet topology
-      a_id = self.agg_key[instr[1]]
-      c_id = self.core_key[instr[2]]
-      if instr[0] == "CONNECT":
-        self.network.add_link(a_id, c_id, 1)
-        self.mininet.addLink('s%d' % a_id, 's%d' % c_id)
-        print("Adding 1 link between switch {} and {}".format(a_id, c_id))
-      elif instr[0] == "DISCONNECT":
-        self.network.remove_link(a_id, c_id, 1)
-        self.mininet.delLink('s%d' % a_id, 's%d' % c_id)
-        print("Removing 1 link between switch {} and {}".format(a_id, c_id))
-
-      if i % pace == 0:
-        # reroute every pace instructions
-        routes = self.network.route_ecmp()
-        self.priority += 1
-        for s_id in routes.keys():
-          for h_id in routes[s_id].keys():
-            self.install_flow(self.switches[s_id], 
-                              (10 << 24) + h_id, routes[s_id][h_id], 
-                              pr=self.priority)
-
-    # Final rerouting before exit        
-    routes = self.network.route_ecmp()
-    self.priority += 1
-    for s_id in routes.keys():
-      for h_id in routes[s_id].keys():
-        self.install_flow(self.switches[s_id], 
-                          (10 << 24) + h_id, routes[s_id][h_id], 
-                          pr=self.priority)
+    self.add_switches([(level, nports)], pace=pace)
+
+  def add_switches(self, blocks, pace=2, reorder=False):
+    """ Add several spine or server block switches with a single rewiring
+    solve, applying one combined link movement plan
+
+    Args:
+          blocks (list): (level, nports) pairs of the switches to add
+          pace (int): number of instructions to install before rerouting,
+            recommended by CapacitySimulator.recommend_pace if None
+          reorder (bool): reorder the plan to keep agg->core capacity high
+            during the transition, see CapacitySimulator.reorder
+
+    """
+    with self.instrument.expansion(blocks=list(blocks), pace=pace):
+      self.register_blocks(blocks)
+
+      instructions = self.rewiring().rewire_batch(blocks)
+      if not instructions.optimal:
+        self.logger.warning("Rewiring not proven optimal (%s), gap %s",
+                            instructions.status, instructions.gap)
+
+      if reorder or pace is None or self.instrument.enabled:
+        with self.instrument.phase('simulate'):
+          simulator = CapacitySimulator.from_network(self.network)
+          if reorder:
+            instructions = simulator.reorder(instructions)
+          if pace is None:
+            pace = simulator.recommend_pace(instructions)
+            self.instrument.set('pace', pace)
+          report = simulator.replay(instructions)
+        self.instrument.set('min_uplinks', int(report.min_uplinks.min()))
+        self.instrument.set('min_pod_throughput', float(report.pod_throughput.min()))
+      # apply and reroute every pace instructions as one link batch
+      for start in range(0, len(instructions), pace):
+        self.apply_links([self.link_change(instr) 
+                          for instr in instructions[start:start + pace]])
+        self.reroute()
+      if not instructions:
+        self.reroute()
+
+  def add_switches_streaming(self, blocks, pacer=None):
+    """ Add spine or server block switches, applying link instructions as
+    the rewiring plan streams out while a separate green thread reroutes
+    and installs flows. Rerouting is paced by time and applying links waits
+    on in-flight FlowMods, see Pacer.
+
+    Args:
+          blocks (list): (level, nports) pairs of the switches to add
+          pacer (Pacer): pacing policy, Pacer() if None
+
+    """
+    pacer = pacer or Pacer()
+    wake = hub.Event()
+    state = {'done': False}
+
+    def router():
+      while True:
+        wake.wait()
+        wake.clear()
+        if pacer.pending:
+          count = pacer.pending
+          self.reroute()
+          pacer.rerouted(count)
+        if state['done']:
+          return
+
+    with self.instrument.expansion(blocks=list(blocks), 
+                                   time_budget=pacer.time_budget,
+                                   max_inflight=pacer.max_inflight):
+      self.register_blocks(blocks)
+      pacer.rerouted()
+      worker = hub.spawn(router)
+      try:
+        for instr in self.rewiring().rewire_iter(blocks):
+          deadline = pacer.clock() + pacer.max_wait
+          while not pacer.can_apply(self.inflight):
+            if pacer.clock() >= deadline:
+              self.logger.warning("Applying links with %d FlowMods unacknowledged "
+                                  "after %.1fs", self.inflight, pacer.max_wait)
+              break
+            hub.sleep(pacer.poll)
+          self.apply_instruction(instr)
+          pacer.changed()
+          if pacer.due():
+            wake.set()
+          # let the router and OpenFlow handlers run
+          hub.sleep(0)
+      finally:
+        state['done'] = True
+        wake.set()
+        hub.joinall([worker])
+
+      # Final rerouting before exit        
+      self.reroute()
+
+  def register_blocks(self, blocks):
+    """ Add the switches of new spine or server /blocks/ to the network
+    state and mininet topology """
+    with self.instrument.phase('topology'):
+      for level, nports in blocks:
+        self.network.max_sid += 1 
+        sid = self.network.max_sid 
+        self.mininet.addSwitch('s%d' % sid, dpid=("%0.2X" % sid), 
+                                protocols='OpenFlow10')
+        if level == 'spine':
+          stype = 'core'
+          self.core_key[len(self.core_key)] = sid
+        else: 
+          stype = 'agg'
+          self.agg_key[len(self.agg_key)] = sid
+
+        self.network.add_switch(sid, nports, stype)
+
+  def apply_instruction(self, instr):
+    """ Add or delete the link of a rewiring instruction from network state
+    and mininet topology """
+    self.apply_links([self.link_change(instr)])
+
+  def link_change(self, instr):
+    """ (agg id, core id, +1 or -1) link change of a rewiring instruction """
+    delta = 1 if instr[0] == "CONNECT" else -1
+    return (self.agg_key[instr[1]], self.core_key[instr[2]], delta)
+
+  def apply_links(self, changes):
+    """ Apply a batch of (nid1, nid2, delta) switch link changes to network
+    state and the mininet topology as one transaction: counts of a pair are
+    summed first, and if mininet fails both are rolled back. Mininet links
+    are placed on the very ports network state assigned them.
+
+    Returns:
+          net (dict): (nid1, nid2) -> summed delta applied
+
+    """
+    with self.instrument.phase('topology'):
+      net = self.network.apply_link_changes(changes)
+      try:
+        self.sync_emulated_links(net)
+      except Exception:
+        self.network.apply_link_changes([(nid1, nid2, -delta) 
+                                         for (nid1, nid2), delta in net.items()])
+        self.sync_emulated_links(net)
+        raise
+    self.instrument.count('links_changed', sum(abs(delta) for delta in net.values()))
+    self.logger.info("Applied %d link changes over %d switch pairs",
+                     sum(abs(delta) for delta in net.values()), len(net))
+    return net
+
+  def sync_emulated_links(self, pairs):
+    """ Make the mininet links between every (nid1, nid2) of /pairs/ match
+    network state port for port. Stale links of every pair are deleted
+    before any link is added, as added links may reuse their ports. """
+    missing = []
+    for nid1, nid2 in pairs:
+      node1, node2 = self.mininet['s%d' % nid1], self.mininet['s%d' % nid2]
+      ports1 = self.network.link_ports(nid1, nid2)
+      ports2 = self.network.link_ports(nid2, nid1)
+      kept1, kept2 = set(), set()
+      for port1, port2, link in self.emulated_links(node1, node2):
+        if port1 in ports1 and port2 in ports2:
+          kept1.add(port1)
+          kept2.add(port2)
+        else:
+          self.del_emulated_link(link)
+      missing += [(node1, node2, port1, port2) for port1, port2 in 
+                  zip([p for p in ports1 if p not in kept1],
+                      [p for p in ports2 if p not in kept2])]
+    for node1, node2, port1, port2 in missing:
+      self.add_emulated_link(node1, node2, port1, port2)
+
+  def emulated_links(self, node1, node2):
+    """ (port of node1, port of node2, link) of every mininet link between
+    /node1/ and /node2/ """
+    links = []
+    for port1, intf in list(node1.intfs.items()):
+      link = getattr(intf, 'link', None)
+      if link is None:
+        continue
+      other = link.intf2 if link.intf1 is intf else link.intf1
+      if other.node is node2:
+        links.append((port1, node2.ports[other], link))
+    return links
+
+  def add_emulated_link(self, node1, node2, port1=None, port2=None):
+    """ Add a mininet link on the given ports and attach its interfaces to
+    running switches """
+    link = self.mininet.addLink(node1, node2, port1=port1, port2=port2)
+    for intf in (link.intf1, link.intf2):
+      attach = getattr(intf.node, 'attach', None)
+      if attach is not None:
+        attach(intf)
+    return link
+
+  def del_emulated_link(self, link):
+    """ Detach a mininet link's interfaces from running switches and delete
+    it """
+    for intf in (link.intf1, link.intf2):
+      detach = getattr(intf.node, 'detach', None)
+      if detach is not None:
+        detach(intf)
+    self.mininet.delLink(link)
+
+  def reroute(self, extra=()):
+    """ Recompute the routes affected by link changes since the last
+    rerouting and sync the flow tables of the switches whose routes changed,
+    plus switches /extra/ """
+    with self.instrument.phase('routing'):
+      delta = self.network.route_incremental()
+    self.instrument.count('routes_changed', len(delta))
+    s_ids = set(s_id for s_id, _h_id, _old, _new in delta) | set(extra)
+    if self.weighted and s_ids:
+      balance = self.network.route_balance(sorted(s_ids))
+      self.instrument.set('route_balance', max(balance.values()))
+    with self.instrument.phase('flow_install'):
+      return self.sync_routes(sorted(s_ids))
 
   def initial_network1(self):
     """ Sample starting network onto which we'll add nodes """
@@ -171,7 +491,6 @@ class Controller(app_manager.RyuApp):
     a_c = [(13,17,2),(14,17,1),(13,18,1),(14,18,2),(15,17,2),(16,17,1),(15,18,1),(16,18,2)] 
 
     for link in h_e + e_a + a_c:
-      print(link)
       net.add_link(*link)
     return net
 
@@ -0,0 +1,123 @@
+import json, time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class Instrumentation(object):
+  """ Per-phase timings and counters of expansions
+
+  Every expansion produces one record {'info', 'phases', 'counters'}, where
+  phases accumulate seconds per phase name. Expansions nest: an inner
+  expansion (e.g. MinimalRewiringILP.rewire_batch called by the controller)
+  adds to the outer record. Hooks are callables hook(event, data), called
+  with ('phase', {'name', 'seconds'}) after every phase and with
+  ('expansion', record) once a record is complete.
+
+  Args:
+        hooks (list): initial hooks
+
+  """
+  enabled = True
+
+  def __init__(self, hooks=None):
+    self.hooks = list(hooks or [])
+    self.records = []                     # completed expansion records
+    self.current = None                   # record of the running expansion
+
+  def add_hook(self, hook):
+    self.hooks.append(hook)
+
+  def notify(self, event, data):
+    for hook in self.hooks:
+      hook(event, data)
+
+  @contextmanager
+  def expansion(self, **info):
+    """ Collect the phases and counters of one expansion into a record """
+    if self.current is not None:
+      self.current['info'].update(info)
+      yield self.current
+      return
+
+    self.current = {'info': info, 'phases': defaultdict(float),
+                    'counters': {}, 'start': time.time()}
+    start = time.perf_counter()
+    try:
+      yield self.current
+    finally:
+      record, self.current = self.current, None
+      record['phases'] = dict(record['phases'])
+      record['seconds'] = time.perf_counter() - start
+      self.records.append(record)
+      self.notify('expansion', record)
+
+  @contextmanager
+  def phase(self, name):
+    """ Time the enclosed block as phase /name/ """
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      seconds = time.perf_counter() - start
+      if self.current is not None:
+        self.current['phases'][name] += seconds
+      self.notify('phase', {'name': name, 'seconds': seconds})
+
+  def count(self, name, value=1):
+    """ Add /value/ to counter /name/ of the running expansion """
+    if self.current is not None:
+      counters = self.current['counters']
+      counters[name] = counters.get(name, 0) + value
+
+  def set(self, name, value):
+    """ Set counter /name/ of the running expansion to /value/ """
+    if self.current is not None:
+      self.current['counters'][name] = value
+
+  def dump(self, path):
+    """ Append completed records to /path/ as JSON lines """
+    with open(path, 'a') as fp:
+      for record in self.records:
+        fp.write(json.dumps(record, default=_to_json) + '\n')
+
+
+class NullInstrumentation(Instrumentation):
+  """ Disabled instrumentation, every call is a no-op """
+  enabled = False
+
+  def __init__(self):
+    self.hooks = []
+    self.records = []
+    self.current = None
+
+  def add_hook(self, hook):
+    raise ValueError("Cannot add hooks to disabled instrumentation.")
+
+  def expansion(self, **info):
+    return _NULL_CONTEXT
+
+  def phase(self, name):
+    return _NULL_CONTEXT
+
+  def count(self, name, value=1):
+    pass
+
+  def set(self, name, value):
+    pass
+
+
+class _NullContext(object):
+  def __enter__(self):
+    return None
+
+  def __exit__(self, *exc):
+    return False
+
+
+_NULL_CONTEXT = _NullContext()
+NULL = NullInstrumentation()
+
+
+def _to_json(value):
+  """ Fallback JSON conversion for numpy scalars and other values """
+  return value.item() if hasattr(value, 'item') else str(value)
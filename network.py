@@ -1,7 +1,11 @@
 import numpy as np
-import networkx as nx 
 from collections import defaultdict
-import json, sys 
+from concurrent.futures import ProcessPoolExecutor
+import json, os, struct
+
+STYPES = ('host', 'edge', 'agg', 'core')  # integer codes of switch types
+GRANULARITIES = ('host', 'edge', 'pod')   # units of ECMP port choice
+ROUTE_MODES = ('ecmp', 'wcmp')            # how uplinks share destinations
 
 class Switch(object):
   def __init__(self, nid, nports, stype, num):
@@ -31,15 +35,30 @@ class Network(object):
   def __init__(self):
     self.edges = defaultdict(int)         # edges[(nid1, nid2)] = num_links
     self.switches = {}                    # nodes[nid] = {'type', 'nports', 'num'}
-    self.routes = defaultdict(dict)       # routes[id] = {dst : port_num}
+    self.routes = RouteTable()            # routes[id] = {dst : port_num}
+    self.route_seed = 0                   # seed of the ECMP hash
+    self.route_granularity = 'host'       # unit hashed by ECMP, see route_ecmp
+    self.route_mode = 'ecmp'              # equal or weighted next hops
+    self.route_ctx = None                 # cached route_index
     self.max_sid = 0                      # largest switch id in network
+    self.dirty = set()                    # switches touched since last routing
+    self.pod_dirty = set()                # edges/aggs whose pod membership changed
+    self.by_type = {'host':[], 'edge':[], 'agg':[], 'core':[]}  # type -> [nid]
+    self.pairs = {}                       # pairs[(min nid, max nid)] = num_links
+    self.journal = None                   # Journal recording every mutation
 
     self.counts = {'host':0, 'edge':0, 'agg':0, 'core':0}
 
   def add_switch(self, sid, nports, stype):
+    if self.journal is not None:
+      self.journal.record(Journal.ADD_SWITCH, sid, nports, STYPES.index(stype))
     self.max_sid = max(self.max_sid, sid)
     self.switches[sid] = Switch(sid, nports, stype, self.counts[stype])
     self.counts[stype] += 1
+    self.by_type[stype].append(sid)
+    self.dirty.add(sid)
+    if stype == 'host':
+      self.route_ctx = None
 
   def add_link(self, nid1, nid2, count):
     """ Add /count/ links between switches /nid1/ and /nid2/"""
@@ -52,11 +71,11 @@ class Network(object):
       raise Exception('Not enough ports for edge.')
 
     eports1 = self.switches[nid1].eports
-    self.switches[nid1].links[nid2] =  [eports1[i] for i in range(count)]
+    self.switches[nid1].links[nid2] += [eports1[i] for i in range(count)]
     self.switches[nid1].eports = eports1[count:]
 
     eports2 = self.switches[nid2].eports
-    self.switches[nid2].links[nid1] =  [eports2[i] for i in range(count)]
+    self.switches[nid2].links[nid1] += [eports2[i] for i in range(count)]
     self.switches[nid2].eports = eports2[count:]
 
     self.switches[nid1].nlinks += count 
@@ -68,6 +87,11 @@ class Network(object):
       self.switches[nid2].uplinks += count 
 
     self.edges[(nid1, nid2)] += count
+    key = (min(nid1, nid2), max(nid1, nid2))
+    self.pairs[key] = self.pairs.get(key, 0) + count
+    self.touch(nid1, nid2)
+    if self.journal is not None:
+      self.journal.record(Journal.ADD_LINK, nid1, nid2, count)
 
   def remove_link(self, nid1, nid2, count):
     """ Remove /count/ links between switches /nid1/ and /nid2/""" 
@@ -92,94 +116,524 @@ class Network(object):
       self.switches[nid2].uplinks -= count 
 
     self.edges[(nid1, nid2)] -= count
+    key = (min(nid1, nid2), max(nid1, nid2))
+    self.pairs[key] = self.pairs.get(key, 0) - count
+    if self.pairs[key] <= 0:
+      del self.pairs[key]
+    self.touch(nid1, nid2)
+    if self.journal is not None:
+      self.journal.record(Journal.REMOVE_LINK, nid1, nid2, count)
+
+  def apply_link_changes(self, changes):
+    """ Apply a batch of link changes as one transaction: counts of the same
+    pair are summed, removals go first so their ports are free for the
+    additions, and if any change fails the ones already applied are undone
+    before the error propagates. Undone links may land on other ports.
+
+    Args:
+          changes (list): (nid1, nid2, delta) tuples, adding delta links if
+            positive and removing -delta links if negative
+
+    Returns:
+          net (dict): (nid1, nid2) -> summed delta of every pair that
+            changed, in the orientation the pair first appeared in
 
-  def route_ecmp(self):
-    """ Compute ECMP routing paths for each switch in the network """
-    # routing for edges
-    for e_id in self.get_type('edge'):
-      # uplink ports to distribute over
-      n_uplinks = self.switches[e_id].uplinks
-      nports = self.switches[e_id].nports 
-      up_ports = list(range(nports - n_uplinks + 1, nports + 1))
-      count = 0
-
-      for h_id in self.get_type('host'):
-        if self.linked(e_id, h_id):
-          self.routes[e_id][h_id] = self.switches[e_id].links[h_id][0]
+    """
+    net, pair = {}, {}
+    for nid1, nid2, delta in changes:
+      key = pair.setdefault((min(nid1, nid2), max(nid1, nid2)), (nid1, nid2))
+      net[key] = net.get(key, 0) + delta
+    net = dict((key, delta) for key, delta in net.items() if delta)
+
+    done = []
+    try:
+      for (nid1, nid2), delta in sorted(net.items(), key=lambda item: item[1]):
+        if delta < 0:
+          self.remove_link(nid1, nid2, -delta)
         else:
-          self.routes[e_id][h_id] = up_ports[count % n_uplinks]
-          count += 1
-
-    # routing for aggs
-    for a_id in self.get_type('agg'):
-      # hosts within agg switches' pod 
-      hosts = {} 
-      for e_id in self.switches[a_id].links.keys():
-        if self.switches[e_id].stype == 'edge':
-          for h_id in self.switches[e_id].links.keys():
-            if self.switches[h_id].stype == 'host':
-              hosts[h_id] = e_id
-
-      # uplink ports to distribute over
-      n_uplinks = self.switches[a_id].uplinks
-      nports = self.switches[a_id].nports 
-      up_ports = list(range(nports - n_uplinks + 1, nports + 1))
-      count = 0
-
-      for h_id in self.get_type('host'):
-        if h_id in hosts.keys(): 
-          e_id = hosts[h_id]
-          self.routes[a_id][h_id] = self.switches[a_id].links[e_id][0]
+          self.add_link(nid1, nid2, delta)
+        done.append((nid1, nid2, delta))
+    except Exception:
+      for nid1, nid2, delta in reversed(done):
+        if delta < 0:
+          self.add_link(nid1, nid2, -delta)
         else:
-          self.routes[a_id][h_id] = up_ports[count % n_uplinks]
-          count += 1
-
-    # routing for core
-    for c_id in self.get_type('core'):
-      # map host to list of agg switches that can lead to host
-      hosts = defaultdict(list)
-      for a_id in self.switches[c_id].links.keys():
-        for e_id in self.switches[a_id].links.keys():
-          if self.switches[e_id].stype == 'edge':
-            for h_id in self.switches[e_id].links.keys():
-              if self.switches[h_id].stype == 'host':
-                hosts[h_id].append(a_id) 
-
-      # randomly choose one of the mapped agg switches
-      for h_id in self.get_type('host'): 
-        a_ids = hosts[h_id]
-        opt_ports = []
-        for a_id in a_ids:
-          opt_ports += self.switches[c_id].links[a_id]
-        self.routes[c_id][h_id] = np.random.choice(opt_ports) 
+          self.remove_link(nid1, nid2, delta)
+      raise
+    return net
+
+  def touch(self, nid1, nid2):
+    """ Record that the links between /nid1/ and /nid2/ changed """
+    self.dirty.update((nid1, nid2))
+    types = {self.switches[nid1].stype, self.switches[nid2].stype}
+    if types == {'host', 'edge'} or types == {'edge', 'agg'}:
+      self.pod_dirty.update(nid for nid in (nid1, nid2) 
+                            if self.switches[nid].stype != 'host')
+      self.route_ctx = None
+
+  def route_ecmp(self, seed=None, granularity=None, mode=None):
+    """ Compute ECMP routing paths for each switch in the network, one
+    vectorized pass per tier over chunks of switches
+
+    Args:
+          seed (int): seed of the ECMP hash, the seed of the last routing
+            pass if None. Routes only depend on the topology and the seed.
+          granularity (string): 'host', 'edge' or 'pod', the unit whose
+            hosts all take the same uplinks. Coarser units let routes be
+            aggregated into prefixes, see addressing.AddressPlan. Kept
+            from the last routing pass if None.
+          mode (string): 'ecmp' spreads destinations evenly over the ports
+            of a switch, 'wcmp' in proportion to the capacity behind each
+            port, see route_weights. Kept from the last routing pass if None.
+
+    """
+    self.route_options(seed, granularity, mode)
+    for _type in ('edge', 'agg', 'core'):
+      for sids in self.route_chunks(self.get_type(_type)):
+        self.routes.set_rows(sids, self.route_rows(sids))
+
+    self.dirty.clear()
+    self.pod_dirty.clear()
+    return self.routes
+
+  def route_parallel(self, workers=None, chunksize=None, seed=None,
+                     granularity=None, mode=None):
+    """ Compute ECMP routing paths for each switch in the network, spread
+    over a process pool working from a read-only snapshot of the topology.
+    Routes only depend on /seed/, never on the number of workers, and match
+    route_ecmp(seed=seed).
+
+    Args:
+          workers (int): number of processes, os.cpu_count() if None
+          chunksize (int): switches per task, about four tasks per worker
+            if None
+          seed (int): seed of the ECMP hash, see route_ecmp
+          granularity (string): unit taking the same uplinks, see route_ecmp
+          mode (string): 'ecmp' or 'wcmp', see route_ecmp
 
+    """
+    self.route_options(seed, granularity, mode)
+    types = [_type for _type in ('edge', 'agg', 'core') if self.get_type(_type)]
+    if not types:
+      return self.routes
+
+    # build the host index once so workers don't each rediscover pods
+    self.route_index()
+    snapshot = object.__new__(type(self))
+    snapshot.__dict__.update(self.__dict__)
+    snapshot.routes = RouteTable()
+
+    workers = workers or os.cpu_count() or 1
+    if chunksize is None:
+      total = sum(len(self.get_type(_type)) for _type in types)
+      chunksize = max(1, -(-total // (4 * workers)))
+    # chunks never mix tiers, every task is one vectorized pass
+    chunks = [chunk for _type in types 
+              for chunk in self.route_chunks(self.get_type(_type), chunksize)]
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_route_worker,
+                             initargs=(snapshot,)) as pool:
+      for sids, rows in zip(chunks, pool.map(_route_chunk, chunks)):
+        self.routes.set_rows(sids, rows)
+
+    self.dirty.clear()
+    self.pod_dirty.clear()
     return self.routes
 
+  def route_incremental(self):
+    """ Recompute only the routes affected by links changed since the last
+    routing pass. Core switches keep their installed ports wherever still
+    valid in ECMP mode, other routes match a fresh route_ecmp.
+
+    Returns:
+          delta (list): (switch, host, old_port, new_port) for every route
+            entry that changed, with None for missing entries
+
+    """
+    affected = set(sid for sid in self.dirty 
+                   if self.switches[sid].stype != 'host')
+
+    if self.pod_dirty or any(self.switches[sid].stype == 'host' for sid in self.dirty):
+      # a host joined or a host:edge or edge:agg link changed: host columns,
+      # pods and ECMP units of route_index are renumbered, and round robin
+      # edges rank every host, so every switch is rerouted
+      affected = set(sid for _type in ('edge', 'agg', 'core') 
+                     for sid in self.get_type(_type))
+
+    if self.route_mode == 'wcmp':
+      # edges weigh aggs by their core links, aggs weigh cores by the links
+      # of every pod to them
+      dirty_aggs = [sid for sid in affected if self.switches[sid].stype == 'agg']
+      cores = set(sid for sid in affected if self.switches[sid].stype == 'core')
+      for a_id in dirty_aggs:
+        cores.update(self.neighbors(a_id, 'core'))
+        affected.update(self.neighbors(a_id, 'edge'))
+      for c_id in cores:
+        affected.update(self.neighbors(c_id, 'agg'))
+
+    hosts = self.route_index()['hosts']
+    delta = []
+    for _type in ('edge', 'agg', 'core'):
+      sids = sorted(sid for sid in affected if self.switches[sid].stype == _type)
+      for chunk in self.route_chunks(sids):
+        old = self.routes.get_rows(chunk)
+        new = self.route_rows(chunk, previous=old)
+        rows, cols = np.nonzero(old != new)
+        for sid, h_id, o, n in zip(chunk[rows].tolist(), hosts[cols].tolist(),
+                                   old[rows, cols].tolist(), new[rows, cols].tolist()):
+          delta.append((sid, h_id, o if o >= 0 else None, n if n >= 0 else None))
+        self.routes.set_rows(chunk, new)
+
+    self.dirty.clear()
+    self.pod_dirty.clear()
+    return delta
+
+  def route_options(self, seed=None, granularity=None, mode=None):
+    """ Set the ECMP hash seed, granularity and mode of later routing passes """
+    if seed is not None:
+      self.route_seed = seed
+    if mode is not None:
+      if mode not in ROUTE_MODES:
+        raise ValueError("Unknown routing mode '{}'.".format(mode))
+      self.route_mode = mode
+    if granularity is not None and granularity != self.route_granularity:
+      if granularity not in GRANULARITIES:
+        raise ValueError("Unknown routing granularity '{}'.".format(granularity))
+      self.route_granularity = granularity
+      self.route_ctx = None
+
+  def route_chunks(self, sids, size=None):
+    """ Split /sids/ into arrays small enough that a chunk's route rows
+    stay around four million entries """
+    if size is None:
+      size = max(1, (1 << 22) // max(1, len(self.get_type('host'))))
+    sids = np.asarray(sids, dtype=np.int64)
+    return [sids[i:i + size] for i in range(0, len(sids), size)]
+
+  def route_index(self):
+    """ Host columns of the route table with the edge switch, edge port,
+    pod and ECMP unit of every host. A pod groups the edges linked to the
+    same set of agg switches. Cached until a host joins, a host:edge or
+    edge:agg link changes or the routing granularity changes. """
+    if self.route_ctx is not None:
+      return self.route_ctx
+
+    self.routes.add_hosts(self.get_type('host'))
+    hosts = np.asarray(self.routes.hosts, dtype=np.int64)
+    edge = np.full(len(hosts), -1, dtype=np.int64)
+    port = np.full(len(hosts), -1, dtype=np.int64)
+    for i, h_id in enumerate(self.routes.hosts):
+      e_ids = self.neighbors(h_id, 'edge')
+      if e_ids:
+        edge[i] = e_ids[0]
+        port[i] = self.link_ports(e_ids[0], h_id)[0]
+
+    pods, edge_pod = {}, {}
+    for e_id in np.unique(edge[edge >= 0]).tolist():
+      aggs = tuple(sorted(self.neighbors(e_id, 'agg')))
+      edge_pod[e_id] = pods.setdefault(aggs, len(pods))
+    pod = np.array([edge_pod.get(e_id, -1) for e_id in edge.tolist()], dtype=np.int64)
+
+    # ECMP hashes the host's unit, unattached hosts are their own unit
+    if self.route_granularity == 'edge':
+      key = np.where(edge >= 0, edge, -hosts)
+    elif self.route_granularity == 'pod':
+      key = np.where(pod >= 0, pod, -hosts)
+    else:
+      key = hosts
+    unit = np.unique(key, return_inverse=True)[1].reshape(-1)
+
+    self.route_ctx = {'hosts': hosts, 'edge': edge, 'port': port, 'pod': pod,
+                      'pod_aggs': [set(aggs) for aggs in pods],
+                      'key': key, 'unit': unit}
+    return self.route_ctx
+
+  def uplink_matrix(self, sids):
+    """ Uplink ports of every switch in /sids/ as rows padded with -1, and
+    the number of uplink ports per row """
+    ups = [self.uplink_ports(sid) for sid in sids]
+    n_up = np.array([len(ports) for ports in ups], dtype=np.int64)
+    matrix = np.full((len(ups), max(1, n_up.max(initial=0))), -1, dtype=np.int64)
+    for k, ports in enumerate(ups):
+      matrix[k, :len(ports)] = ports
+    return matrix, n_up
+
+  def route_switch(self, sid, seed=None):
+    """ Compute the ECMP routes of switch /sid/ towards every host
+
+    Returns:
+          routes (dict): host id -> out port
+
+    """
+    if seed is not None:
+      self.route_seed = seed
+    if self.switches[sid].stype == 'host':
+      return {}
+    row = self.route_rows(np.array([sid]))[0]
+    cols = np.flatnonzero(row >= 0)
+    return dict(zip(self.route_index()['hosts'][cols].tolist(), row[cols].tolist()))
+
+  def route_rows(self, sids, previous=None):
+    """ Route rows of switches /sids/, all of one tier, over the host
+    columns of route_index
+
+    Args:
+          sids (np.ndarray): switch ids
+          previous (np.ndarray): route rows currently installed on core
+            switches, kept wherever still valid so that reroutes only move
+            what they must (ECMP only)
+
+    Returns:
+          rows (np.ndarray): out port per switch and host, -1 if none
+
+    """
+    stype = self.switches[int(sids[0])].stype
+    if self.route_mode == 'wcmp' and stype in ('edge', 'agg', 'core'):
+      return self.route_weighted(sids)
+    elif stype == 'edge':
+      return self.route_edges(sids)
+    elif stype == 'agg':
+      return self.route_aggs(sids)
+    elif stype == 'core':
+      return self.route_cores(sids, previous)
+    return np.full((len(sids), len(self.route_index()['hosts'])), -1, dtype=np.int64)
+
+  def route_edges(self, e_ids):
+    # local hosts leave through their host port, the others go round robin
+    # over the uplinks in host (or unit) order
+    ctx = self.route_index()
+    local = ctx['edge'][None, :] == e_ids[:, None]
+    rows = np.where(local, ctx['port'][None, :], -1)
+    up, n_up = self.uplink_matrix(e_ids)
+    if self.route_granularity == 'host':
+      rank = np.cumsum(~local, axis=1) - 1
+    else:
+      rank = np.broadcast_to(ctx['unit'], local.shape)
+    pick = np.take_along_axis(up, rank % np.maximum(n_up, 1)[:, None], axis=1)
+    return np.where(~local & (n_up > 0)[:, None], pick, rows)
+
+  def route_aggs(self, a_ids):
+    # hosts within the agg's pod go down towards their edge, the others are
+    # hashed over the uplinks
+    ctx = self.route_index()
+    rows = np.full((len(a_ids), len(ctx['hosts'])), -1, dtype=np.int64)
+    attached = ctx['edge'] >= 0
+    down = np.full(self.max_sid + 1, -1, dtype=np.int64)
+    for k, a_id in enumerate(a_ids.tolist()):
+      e_ids = self.neighbors(a_id, 'edge')
+      for e_id in e_ids:
+        down[e_id] = self.link_ports(a_id, e_id)[0]
+      rows[k, attached] = down[ctx['edge'][attached]]
+      down[e_ids] = -1
+
+    up, n_up = self.uplink_matrix(a_ids)
+    h = ecmp_hash(self.route_seed, a_ids[:, None], ctx['key'][None, :])
+    pick = np.take_along_axis(up, hash_index(h, np.maximum(n_up, 1)[:, None]), axis=1)
+    return np.where((rows < 0) & (n_up > 0)[:, None], pick, rows)
+
+  def route_cores(self, c_ids, previous=None):
+    # a host's options are the ports towards aggs of its pod, hashed per
+    # (core, host) and weighted by link count
+    ctx = self.route_index()
+    pod, n_pods = ctx['pod'], len(ctx['pod_aggs'])
+    in_pod = pod >= 0
+    rows = np.full((len(c_ids), len(ctx['hosts'])), -1, dtype=np.int64)
+    h = ecmp_hash(self.route_seed, c_ids[:, None], ctx['key'][None, :])
+    for k, c_id in enumerate(c_ids.tolist()):
+      ports = {a_id: self.link_ports(c_id, a_id) for a_id in self.neighbors(c_id, 'agg')}
+      options = [sorted(p for a_id in aggs if a_id in ports for p in ports[a_id])
+                 for aggs in ctx['pod_aggs']]
+      n_opt = np.array([len(opts) for opts in options] + [0], dtype=np.int64)
+      matrix = np.full((n_pods + 1, max(1, n_opt.max())), -1, dtype=np.int64)
+      for g, opts in enumerate(options):
+        matrix[g, :len(opts)] = opts
+
+      # pod -1 (unattached hosts) indexes the trailing empty row
+      n_host = n_opt[pod]
+      pick = matrix[pod, hash_index(h[k], np.maximum(n_host, 1))]
+      rows[k] = np.where(n_host > 0, pick, -1)
+
+      if previous is not None:
+        valid = np.zeros((n_pods + 1, self.switches[c_id].nports + 1), dtype=bool)
+        for g, opts in enumerate(options):
+          valid[g, opts] = True
+        prev = previous[k]
+        keep = in_pod & (prev > 0) & (prev < valid.shape[1])
+        keep[keep] = valid[pod[keep], prev[keep]]
+        rows[k, keep] = prev[keep]
+    return rows
+
+  def route_weighted(self, sids):
+    # routes towards local hosts and hosts below an agg are fixed as in
+    # ECMP, the others are split over the weighted ports group by group
+    stype = self.switches[int(sids[0])].stype
+    if stype == 'edge':
+      rows = self.route_edges(sids)
+    elif stype == 'agg':
+      rows = self.route_aggs(sids)
+    else:
+      rows = np.full((len(sids), len(self.route_index()['hosts'])), -1, dtype=np.int64)
+
+    unit, cache = self.route_index()['unit'], {}
+    for k, sid in enumerate(sids.tolist()):
+      for g, (cols, ports, weights) in enumerate(self.route_weights(sid, cache)):
+        units, inv = np.unique(unit[cols], return_inverse=True)
+        seq = wcmp_sequence(weights, len(units))
+        # rotate per switch and group so switches don't all pick alike
+        offset = hash_index(ecmp_hash(self.route_seed, sid, g), len(units))
+        rows[k, cols] = ports[seq[(inv.reshape(-1) + offset) % len(units)]]
+    return rows
+
+  def route_weights(self, sid, cache=None):
+    """ WCMP weights of the ports of switch /sid/ towards every group of
+    destination hosts it splits over several ports. Edges weigh each port
+    by the core links of the agg behind it, aggs weigh a port to core c by
+    min(X[a, c], X[P, c]) / X[a, c] towards the hosts of pod P, where X
+    counts agg:core links, and cores weigh every link to the pod alike.
+
+    Args:
+          sid (int): edge, agg or core switch
+          cache (dict): links of pods to cores shared across calls of one
+            routing pass
+
+    Returns:
+          groups (list): (host columns, ports, weights) of every group, see
+            route_index for the host columns
+
+    """
+    ctx = self.route_index()
+    stype = self.switches[sid].stype
+    cache = {} if cache is None else cache
+    if stype == 'edge':
+      weight = {}
+      for a_id in self.neighbors(sid, 'agg'):
+        for port in self.link_ports(sid, a_id):
+          weight[port] = len(self.uplink_ports(a_id))
+      ports = np.array(sorted(weight), dtype=np.int64)
+      weights = np.array([weight[port] for port in ports.tolist()], dtype=float)
+      if not weights.any():
+        # no agg reaches a core yet, spread as ECMP would
+        weights = np.ones(len(ports))
+      cols = np.flatnonzero(ctx['edge'] != sid)
+      return [(cols, ports, weights)] if len(ports) and len(cols) else []
+
+    if stype == 'agg':
+      below = np.isin(ctx['edge'], self.neighbors(sid, 'edge')) & (ctx['edge'] >= 0)
+      ports, cores = [], []
+      for c_id in self.neighbors(sid, 'core'):
+        for port in self.link_ports(sid, c_id):
+          ports.append(port)
+          cores.append(c_id)
+      if not ports:
+        return []
+      order = np.argsort(ports, kind='stable')
+      ports = np.array(ports, dtype=np.int64)[order]
+      cores = np.array(cores, dtype=np.int64)[order]
+      c_ids, c_idx, own = np.unique(cores, return_inverse=True, return_counts=True)
+      X = np.array([self.pod_core_links(c_id, cache) for c_id in c_ids.tolist()])
+      groups = []
+      for g in np.unique(ctx['pod'][~below]).tolist():
+        cols = np.flatnonzero(~below & (ctx['pod'] == g))
+        weights = np.ones(len(ports))
+        if g >= 0:
+          weights = np.minimum(own, X[:, g])[c_idx.reshape(-1)] / own[c_idx.reshape(-1)]
+          if not weights.any():
+            # no capacity towards the pod, spread as ECMP would
+            weights = np.ones(len(ports))
+        groups.append((cols, ports, weights))
+      return groups
+
+    if stype == 'core':
+      ports = {a_id: self.link_ports(sid, a_id) for a_id in self.neighbors(sid, 'agg')}
+      groups = []
+      for g, aggs in enumerate(ctx['pod_aggs']):
+        options = np.array(sorted(p for a_id in aggs if a_id in ports for p in ports[a_id]),
+                           dtype=np.int64)
+        cols = np.flatnonzero(ctx['pod'] == g)
+        if len(options) and len(cols):
+          groups.append((cols, options, np.ones(len(options))))
+      return groups
+    return []
+
+  def pod_core_links(self, c_id, cache=None):
+    """ Links of core /c_id/ to the aggs of every pod of route_index """
+    if cache is not None and c_id in cache:
+      return cache[c_id]
+    links = np.array([sum(len(self.link_ports(c_id, a_id)) for a_id in aggs)
+                      for aggs in self.route_index()['pod_aggs']], dtype=np.int64)
+    if cache is not None:
+      cache[c_id] = links
+    return links
+
+  def route_balance(self, sids=None):
+    """ Balance error of the installed routes against the WCMP weights: the
+    share of destinations a switch would have to move so that every group
+    of destinations is split over its ports in proportion to their
+    weights, see route_weights. 0 is a perfect split.
+
+    Args:
+          sids (list): switches to measure, every edge, agg and core if None
+
+    Returns:
+          errors (dict): switch id -> balance error
+
+    """
+    if sids is None:
+      sids = [sid for _type in ('edge', 'agg', 'core') for sid in self.get_type(_type)]
+    n_hosts = len(self.route_index()['hosts'])
+    errors, cache = {}, {}
+    for sid in sids:
+      row = self.routes.get_rows([sid])[0, :n_hosts]
+      moved, total = 0.0, 0
+      for cols, ports, weights in self.route_weights(sid, cache):
+        if not weights.any():
+          continue
+        counts = np.array([(row[cols] == port).sum() for port in ports.tolist()])
+        target = weights / weights.sum() * len(cols)
+        moved += np.abs(counts - target).sum() / 2
+        total += len(cols)
+      errors[sid] = moved / total if total else 0.0
+    return errors
+
+  def link_ports(self, nid1, nid2):
+    """ Ports of /nid1/ used by links to /nid2/ """
+    return self.switches[nid1].links.get(nid2, [])
+
+  def uplink_ports(self, nid):
+    """ Sorted ports of /nid/ linked to switches of a higher tier """
+    return sorted(port for peer, ports in self.switches[nid].links.items()
+                  if self.is_up(nid, peer) for port in ports)
+
+  def link_counts(self):
+    """ Iterate over ((min nid, max nid), num_links) of every linked pair """
+    return iter(self.pairs.items())
+
+  def neighbors(self, nid, _type):
+    """ Switches of type /_type/ with at least one link to /nid/ """
+    return [sid for sid, ports in self.switches[nid].links.items() 
+            if ports and self.switches[sid].stype == _type]
 
   def is_up(self, nid1, nid2):
     level = {'host':1, 'edge':2, 'agg':3, 'core':4}
     return level[self.switches[nid1].stype] < level[self.switches[nid2].stype]
 
   def get_type(self, _type):
-    switches = []
-    for idx in self.switches.keys():
-      if self.switches[idx].stype == _type:
-        switches.append(idx)
-    return switches
+    """ Ids of the switches of type /_type/ (shared index, do not mutate) """
+    return self.by_type.get(_type, [])
 
   def linked(self, nid1, nid2):
-    return (nid1, nid2) in self.edges.keys() or (nid2, nid1) in self.edges.keys()
+    return (min(nid1, nid2), max(nid1, nid2)) in self.pairs
 
   def to_nx(self):
+    import networkx as nx
     G = nx.Graph()
     G.add_nodes_from(self.switches.keys())
     for nid in G.nodes(): 
-      G.node[nid]['type'] = self.switches[nid].stype
-      G.node[nid]['num'] = self.switches[nid].num
+      G.nodes[nid]['type'] = self.switches[nid].stype
+      G.nodes[nid]['num'] = self.switches[nid].num
 
-    G.add_edges_from(self.edges.keys())
-    for edge in G.edges:
-      G.edges[edge]["count"] = self.edges[edge]
+    for edge, count in self.link_counts():
+      G.add_edge(*edge, count=count)
     return G
 
   def core_agg_wiring(self):
@@ -188,17 +642,664 @@ class Network(object):
     agg_key = {sid:i for i, sid in enumerate(self.get_type('agg'))}
     wiring = np.zeros((len(agg_key), len(core_key)))
     for c_id in core_key.keys():
-      for a_id in self.switches[c_id].links.keys():
-        wiring[agg_key[a_id], core_key[c_id]] = len(self.switches[c_id].links[a_id])
+      for a_id in self.neighbors(c_id, 'agg'):
+        wiring[agg_key[a_id], core_key[c_id]] = len(self.link_ports(c_id, a_id))
     agg_key = {agg_key[k]: k for k in agg_key.keys()}
     core_key = {core_key[k]: k for k in core_key.keys()}
     return wiring, agg_key, core_key
 
-  def write_graph(self):
+  def write_graph(self, path='../CloudNetVis/netvis/static/netvis/traffic/traffic.json'):
     """ Write json graph for visualization purposes """
+    from networkx.readwrite import json_graph
     G = self.to_nx()
-    g = nx.readwrite.json_graph.node_link_data(G)
-    with open('../CloudNetVis/netvis/static/netvis/traffic/traffic.json', 'w') as fp:
+    g = json_graph.node_link_data(G)
+    with open(path, 'w') as fp:
       json.dump(g, fp, indent=4)
 
+  def save_snapshot(self, path):
+    """ Write switches, ports, links, routes and the core:agg wiring matrix
+    to a NumPy .npz file, see load_snapshot """
+    sids = np.array(list(self.switches.keys()), dtype=np.int64)
+    link_ports, free_ports = self.snapshot_ports()
+    wiring, agg_key, core_key = self.core_agg_wiring()
+    np.savez(path,
+             version=np.array([SNAPSHOT_VERSION]),
+             switch_ids=sids,
+             switch_types=np.array([STYPES.index(self.switches[sid].stype) 
+                                    for sid in sids], dtype=np.int8),
+             switch_nports=np.array([self.switches[sid].nports for sid in sids],
+                                    dtype=np.int32),
+             switch_nums=np.array([self.switches[sid].num for sid in sids], 
+                                  dtype=np.int32),
+             link_ports=np.array(link_ports, dtype=np.int64).reshape(-1, 3),
+             free_ports=np.array(free_ports, dtype=np.int64).reshape(-1, 2),
+             routes=self.routes.entries(),
+             wiring=wiring,
+             agg_ids=np.array([agg_key[i] for i in range(len(agg_key))], dtype=np.int64),
+             core_ids=np.array([core_key[j] for j in range(len(core_key))], dtype=np.int64))
+
+  @classmethod
+  def load_snapshot(cls, path):
+    """ Network restored from a save_snapshot file, ports included """
+    with np.load(path) as data:
+      if int(data['version'][0]) != SNAPSHOT_VERSION:
+        raise ValueError('Unsupported snapshot version {}.'.format(data['version'][0]))
+      net = cls()
+      for sid, code, nports in zip(data['switch_ids'], data['switch_types'], 
+                                   data['switch_nports']):
+        net.add_switch(int(sid), int(nports), STYPES[code])
+      net.restore_ports(data['link_ports'], data['free_ports'])
+      net.routes.set_entries(data['routes'])
+
+    # a snapshot saved before any routing pass leaves every switch dirty,
+    # so the next route_incremental routes the whole network
+    if len(net.routes):
+      net.dirty.clear()
+      net.pod_dirty.clear()
+    return net
+
+  def snapshot_ports(self):
+    """ Port assignment as (sid, peer, port) rows in link order and
+    (sid, port) rows in free port order """
+    link_ports, free_ports = [], []
+    for sid, sw in self.switches.items():
+      for peer, ports in sw.links.items():
+        link_ports += [(sid, peer, port) for port in ports]
+      free_ports += [(sid, port) for port in sw.eports]
+    return link_ports, free_ports
+
+  def restore_ports(self, link_ports, free_ports):
+    """ Rebuild links from snapshot_ports rows of a network without links """
+    for sw in self.switches.values():
+      sw.eports = []
+    for sid, peer, port in link_ports.tolist():
+      sw = self.switches[sid]
+      sw.links[peer].append(port)
+      sw.nlinks += 1
+      if self.is_up(sid, peer):
+        sw.uplinks += 1
+      # count every link once, from its lower end
+      if sid < peer:
+        key = (sid, peer)
+        self.pairs[key] = self.pairs.get(key, 0) + 1
+        self.edges[key] += 1
+    for sid, port in free_ports.tolist():
+      self.switches[sid].eports.append(port)
+
+  def replay(self, path):
+    """ Apply the operations of a Journal file to this network """
+    for op, a, b, c in Journal.read(path).tolist():
+      if op == Journal.ADD_SWITCH:
+        self.add_switch(a, b, STYPES[c])
+      elif op == Journal.ADD_LINK:
+        self.add_link(a, b, c)
+      elif op == Journal.REMOVE_LINK:
+        self.remove_link(a, b, c)
+      else:
+        raise ValueError('Unknown journal operation {}.'.format(op))
+
+
+SNAPSHOT_VERSION = 1
+
+
+class Journal(object):
+  """ Append-only binary journal of network mutations
+
+  Every add_switch, add_link and remove_link of a network whose `journal`
+  is set is appended as one fixed-size record (op, a, b, c): (sid, nports,
+  type code) for switches and (nid1, nid2, count) for links. Replaying the
+  journal over the snapshot it started from restores the network.
+
+  Args:
+        path (string): journal file, appended to
+        sync (bool): flush and fsync after every record
+
+  """
+  ADD_SWITCH, ADD_LINK, REMOVE_LINK = 0, 1, 2
+  RECORD = struct.Struct('<Biii')
+  DTYPE = np.dtype([('op', '<u1'), ('a', '<i4'), ('b', '<i4'), ('c', '<i4')])
+
+  def __init__(self, path, sync=False):
+    self.path = path
+    self.sync = sync
+    self.fp = open(path, 'ab')
+
+  def record(self, op, a, b, c):
+    self.fp.write(self.RECORD.pack(op, a, b, c))
+    if self.sync:
+      self.flush()
+
+  def flush(self):
+    self.fp.flush()
+    os.fsync(self.fp.fileno())
+
+  def reset(self):
+    """ Drop every record, e.g. right after saving a snapshot """
+    self.fp.truncate(0)
+    self.fp.seek(0)
+
+  def close(self):
+    self.fp.close()
+
+  @classmethod
+  def read(cls, path):
+    """ Records of a journal file as a structured array """
+    return np.fromfile(path, dtype=cls.DTYPE)
+
+
+class RouteTable(object):
+  """ Routes of every switch as a dense switch x host matrix of out ports
+
+  Rows and host columns are allocated on first use and entries without a
+  route hold -1. Ports are stored as int16, widened if a port ever needs
+  more. Indexing a switch returns its routes as a {host: port} dict, so the
+  table reads like the routes[id] = {dst: port_num} mapping it replaces.
+  """
+  def __init__(self):
+    self.table = np.full((0, 0), -1, dtype=np.int16)
+    self.row = {}                         # switch id -> row
+    self.col = {}                         # host id -> column
+    self.sids = []                        # switch id of every row
+    self.hosts = []                       # host id of every column
+
+  def add_hosts(self, h_ids):
+    """ Allocate columns for the hosts of /h_ids/ not in the table yet """
+    new = [h_id for h_id in dict.fromkeys(h_ids) if h_id not in self.col]
+    if not new:
+      return
+    for h_id in new:
+      self.col[h_id] = len(self.hosts)
+      self.hosts.append(h_id)
+    table = np.full((self.table.shape[0], len(self.hosts)), -1, dtype=self.table.dtype)
+    table[:, :self.table.shape[1]] = self.table
+    self.table = table
+
+  def rows_of(self, sids, create=False):
+    """ Row of every switch in /sids/, -1 for switches without routes
+    unless /create/ allocates them """
+    if create:
+      for sid in sids:
+        if sid not in self.row:
+          self.row[sid] = len(self.sids)
+          self.sids.append(sid)
+      if len(self.sids) > self.table.shape[0]:
+        table = np.full((max(len(self.sids), 2 * self.table.shape[0]), len(self.hosts)),
+                        -1, dtype=self.table.dtype)
+        table[:self.table.shape[0]] = self.table
+        self.table = table
+    return np.array([self.row.get(sid, -1) for sid in sids], dtype=np.int64)
+
+  def widen(self, ports):
+    if len(ports) and np.max(ports) > np.iinfo(self.table.dtype).max:
+      self.table = self.table.astype(np.int32)
+
+  def get_rows(self, sids):
+    """ Route rows of switches /sids/ over all host columns """
+    idx = self.rows_of(np.asarray(sids).tolist())
+    rows = np.full((len(idx), len(self.hosts)), -1, dtype=np.int64)
+    rows[idx >= 0] = self.table[idx[idx >= 0]]
+    return rows
+
+  def set_rows(self, sids, rows):
+    """ Replace the routes of switches /sids/ by /rows/, whose columns are
+    the first host columns of the table """
+    rows = np.asarray(rows)
+    self.widen(rows.ravel())
+    idx = self.rows_of(np.asarray(sids).tolist(), create=True)
+    self.table[idx, :rows.shape[1]] = rows
+
+  def entries(self):
+    """ (switch, host, port) rows of every route """
+    rows, cols = np.nonzero(self.table[:len(self.sids)] >= 0)
+    return np.stack([np.asarray(self.sids, dtype=np.int64)[rows],
+                     np.asarray(self.hosts, dtype=np.int64)[cols],
+                     self.table[rows, cols].astype(np.int64)], axis=1)
+
+  def set_entries(self, entries):
+    """ Set the routes of (switch, host, port) rows, see entries """
+    entries = np.asarray(entries, dtype=np.int64).reshape(-1, 3)
+    self.add_hosts(entries[:, 1].tolist())
+    self.widen(entries[:, 2])
+    rows = self.rows_of(entries[:, 0].tolist(), create=True)
+    cols = np.array([self.col[h_id] for h_id in entries[:, 1].tolist()], dtype=np.int64)
+    self.table[rows, cols] = entries[:, 2]
+
+  def __getitem__(self, sid):
+    if sid not in self.row:
+      return {}
+    row = self.table[self.row[sid]]
+    cols = np.flatnonzero(row >= 0)
+    return dict(zip(np.asarray(self.hosts)[cols].tolist(), row[cols].tolist()))
+
+  def __setitem__(self, sid, routes):
+    self.add_hosts(routes.keys())
+    row = np.full(len(self.hosts), -1, dtype=np.int64)
+    row[[self.col[h_id] for h_id in routes]] = list(routes.values())
+    self.set_rows([sid], row[None, :])
+
+  def get(self, sid, default=None):
+    return self[sid] if sid in self.row else default
+
+  def __contains__(self, sid):
+    return sid in self.row
+
+  def __len__(self):
+    return len(self.sids)
+
+  def __iter__(self):
+    return iter(list(self.sids))
 
+  def keys(self):
+    return list(self.sids)
+
+  def items(self):
+    return [(sid, self[sid]) for sid in self.sids]
+
+
+_MIX = (np.uint64(0xBF58476D1CE4E5B9), np.uint64(0x94D049BB133111EB))
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _mix64(z):
+  z = z ^ (z >> np.uint64(30))
+  z = z * _MIX[0]
+  z = z ^ (z >> np.uint64(27))
+  z = z * _MIX[1]
+  return z ^ (z >> np.uint64(31))
+
+
+def ecmp_hash(seed, sids, hosts):
+  """ splitmix64 hash of (seed, switch, host), broadcasting /sids/ against
+  /hosts/. Identical on every platform and process. """
+  sids = np.asarray(sids, dtype=np.int64).astype(np.uint64)
+  hosts = np.asarray(hosts, dtype=np.int64).astype(np.uint64)
+  with np.errstate(over='ignore'):
+    z = _mix64(sids * _GOLDEN + np.uint64(seed % (1 << 64)))
+    return _mix64((z + hosts) * _GOLDEN)
+
+
+def hash_index(h, n):
+  """ Index in [0, n) picked by hashes /h/ """
+  return (h % np.asarray(n).astype(np.uint64)).astype(np.int64)
+
+
+def wcmp_sequence(weights, n):
+  """ Indices into /weights/ for /n/ destinations: every index is taken in
+  proportion to its weight (largest remainder), its takes spread evenly
+  along the sequence """
+  weights = np.asarray(weights, dtype=float)
+  quota = weights / weights.sum() * n
+  counts = np.floor(quota).astype(np.int64)
+  rest = n - counts.sum()
+  if rest:
+    counts[np.argsort(counts - quota, kind='stable')[:rest]] += 1
+  idx = np.repeat(np.arange(len(weights)), counts)
+  nth = np.arange(n) - np.repeat(np.cumsum(counts) - counts, counts)
+  return idx[np.argsort((nth + 0.5) / counts[idx], kind='stable')]
+
+
+_route_snapshot = None   # network snapshot of a route_parallel worker
+
+
+def _init_route_worker(snapshot):
+  global _route_snapshot
+  _route_snapshot = snapshot
+
+
+def _route_chunk(sids):
+  return _route_snapshot.route_rows(sids)
+
+class SwitchView(object):
+  """ Read-only Switch lookalike over the arrays of a CompactNetwork """
+  def __init__(self, net, nid):
+    self.net = net
+    self.nid = nid
+
+  @property
+  def stype(self):
+    return STYPES[self.net.stype[self.nid]]
+
+  @property
+  def num(self):
+    return int(self.net.num[self.nid])
+
+  @property
+  def nports(self):
+    return int(self.net.nports[self.nid])
+
+  @property
+  def nlinks(self):
+    return int(self.net.nlinks[self.nid])
+
+  @property
+  def uplinks(self):
+    return int(self.net.uplinks[self.nid])
+
+  @property
+  def links(self):
+    links = defaultdict(list)
+    peers = self.net.port_peers(self.nid)
+    for port in np.flatnonzero(peers >= 0):
+      links[int(peers[port])].append(int(port) + 1)
+    return links
+
+  @property
+  def eports(self):
+    return [int(p) + 1 for p in np.flatnonzero(~self.net.port_used(self.nid))]
+
+  __str__ = Switch.__str__
+
+
+class SwitchTable(object):
+  """ Mapping of switch id to SwitchView for a CompactNetwork """
+  def __init__(self, net):
+    self.net = net
+
+  def __contains__(self, nid):
+    return 0 <= nid < len(self.net.stype) and self.net.stype[nid] >= 0
+
+  def __getitem__(self, nid):
+    if nid not in self:
+      raise KeyError(nid)
+    return SwitchView(self.net, nid)
+
+  def keys(self):
+    return [int(nid) for nid in np.flatnonzero(self.net.stype >= 0)]
+
+  def __iter__(self):
+    return iter(self.keys())
+
+  def __len__(self):
+    return int((self.net.stype >= 0).sum())
+
+  def values(self):
+    return [self[nid] for nid in self.keys()]
+
+  def items(self):
+    return [(nid, self[nid]) for nid in self.keys()]
+
+
+class CompactNetwork(Network):
+  """ Array-backed network state for production-scale fabrics
+
+  Switch attributes live in arrays indexed by switch id, with types stored
+  as integer codes (see STYPES). Every switch owns a block of nports slots
+  in three flat arrays: the peer occupying each port, and CSR-style
+  adjacency of (neighbor, link count) filled up to the switch's degree.
+  Port occupancy is a bitmap over the same slots.
+  `switches` and `edges` are views, so code written against Network keeps
+  working.
+  """
+  def __init__(self):
+    self.routes = RouteTable()            # routes[id] = {dst : port_num}
+    self.route_seed = 0                   # seed of the ECMP hash
+    self.route_granularity = 'host'       # unit hashed by ECMP, see route_ecmp
+    self.route_mode = 'ecmp'              # equal or weighted next hops
+    self.route_ctx = None                 # cached route_index
+    self.max_sid = 0                      # largest switch id in network
+    self.dirty = set()                    # switches touched since last routing
+    self.pod_dirty = set()                # edges/aggs whose pod membership changed
+    self.counts = {'host':0, 'edge':0, 'agg':0, 'core':0}
+    self.by_type = {}                     # cached get_type lists
+    self.journal = None                   # Journal recording every mutation
+
+    # per switch arrays, stype -1 marks an unused id
+    self.stype = np.full(0, -1, dtype=np.int8)
+    self.num = np.zeros(0, dtype=np.int32)
+    self.nports = np.zeros(0, dtype=np.int32)
+    self.nlinks = np.zeros(0, dtype=np.int32)
+    self.uplinks = np.zeros(0, dtype=np.int32)
+    self.base = np.zeros(0, dtype=np.int64)       # first slot of port block
+    self.degree = np.zeros(0, dtype=np.int32)     # used adjacency slots
+    self.cursor = np.zeros(0, dtype=np.int32)     # no free port below this one
+
+    # per port slot arrays
+    self.nslots = 0
+    self.peer = np.zeros(0, dtype=np.int32)       # peer at port, -1 if empty
+    self.adj = np.zeros(0, dtype=np.int32)        # CSR neighbor ids
+    self.adj_count = np.zeros(0, dtype=np.int32)  # CSR link counts
+    self.used = np.zeros(0, dtype=np.uint8)       # port occupancy bitmap
+
+    self.switches = SwitchTable(self)
+
+  @property
+  def edges(self):
+    return dict(self.link_counts())
+
+  def grow(self, arr, size, fill):
+    """ Return /arr/ extended with /fill/ to at least /size/ entries """
+    if len(arr) >= size:
+      return arr
+    new = np.full(max(size, 2 * len(arr)), fill, dtype=arr.dtype)
+    new[:len(arr)] = arr
+    return new
+
+  def add_switch(self, sid, nports, stype):
+    if sid in self.switches:
+      raise KeyError('Switch {} already exists.'.format(sid))
+    if self.journal is not None:
+      self.journal.record(Journal.ADD_SWITCH, sid, nports, STYPES.index(stype))
+    self.stype = self.grow(self.stype, sid + 1, -1)
+    for name in ('num', 'nports', 'nlinks', 'uplinks', 'base', 'degree', 'cursor'):
+      setattr(self, name, self.grow(getattr(self, name), sid + 1, 0))
+
+    base = self.nslots
+    self.nslots = base + nports
+    self.peer = self.grow(self.peer, self.nslots, -1)
+    self.adj = self.grow(self.adj, self.nslots, -1)
+    self.adj_count = self.grow(self.adj_count, self.nslots, 0)
+    self.used = self.grow(self.used, -(-self.nslots // 8), 0)
+
+    code = STYPES.index(stype)
+    self.stype[sid] = code
+    self.num[sid] = self.counts[stype]
+    self.nports[sid] = nports
+    self.base[sid] = base
+    self.counts[stype] += 1
+    self.by_type.pop(stype, None)
+    self.max_sid = max(self.max_sid, sid)
+    self.dirty.add(sid)
+    if stype == 'host':
+      self.route_ctx = None
+
+  def port_peers(self, nid):
+    base = self.base[nid]
+    return self.peer[base:base + self.nports[nid]]
+
+  def bitmap_range(self, nid):
+    """ Byte range of the bitmap covering /nid/'s ports, and bit offset """
+    base = self.base[nid]
+    return base // 8, -(-(base + self.nports[nid]) // 8), base % 8
+
+  def port_used(self, nid):
+    start, stop, offset = self.bitmap_range(nid)
+    bits = np.unpackbits(self.used[start:stop], bitorder='little')
+    return bits[offset:offset + self.nports[nid]].astype(bool)
+
+  def free_ports(self, nid, count):
+    """ Lowest /count/ free local port indices of /nid/, scanning from its
+    cursor """
+    cursor, base, nports = int(self.cursor[nid]), int(self.base[nid]), int(self.nports[nid])
+    free = []
+    while len(free) < count and cursor < nports:
+      if self.peer[base + cursor] < 0:
+        free.append(cursor)
+      cursor += 1
+    self.cursor[nid] = cursor
+    return free
+
+  def set_ports(self, nid, ports, peer):
+    """ Assign local port indices /ports/ of /nid/ to /peer/ (-1 frees) """
+    base = int(self.base[nid])
+    for port in ports:
+      slot = base + int(port)
+      self.peer[slot] = peer
+      if peer >= 0:
+        self.used[slot >> 3] |= 1 << (slot & 7)
+      else:
+        self.used[slot >> 3] &= ~(1 << (slot & 7)) & 0xFF
+        self.cursor[nid] = min(self.cursor[nid], int(port))
+
+  def slot(self, nid1, nid2):
+    """ Absolute adjacency slot of /nid2/ in /nid1/'s block, or -1 """
+    base, degree = int(self.base[nid1]), int(self.degree[nid1])
+    if not degree:
+      return -1
+    idx = base + int((self.adj[base:base + degree] == nid2).argmax())
+    return idx if self.adj[idx] == nid2 else -1
+
+  def touch(self, nid1, nid2):
+    """ Record that the links between /nid1/ and /nid2/ changed, see
+    Network.touch """
+    self.dirty.update((nid1, nid2))
+    codes = sorted((int(self.stype[nid1]), int(self.stype[nid2])))
+    if codes[1] - codes[0] == 1 and codes[1] <= STYPES.index('agg'):
+      self.pod_dirty.update(nid for nid in (nid1, nid2) if self.stype[nid] > 0)
+      self.route_ctx = None
+
+  def adjust_adjacency(self, nid1, nid2, count):
+    idx = self.slot(nid1, nid2)
+    if idx < 0:
+      idx = self.base[nid1] + self.degree[nid1]
+      self.adj[idx] = nid2
+      self.adj_count[idx] = 0
+      self.degree[nid1] += 1
+    self.adj_count[idx] += count
+    if self.adj_count[idx] <= 0:
+      # swap the last used slot into the hole
+      last = self.base[nid1] + self.degree[nid1] - 1
+      self.adj[idx], self.adj_count[idx] = self.adj[last], self.adj_count[last]
+      self.adj[last], self.adj_count[last] = -1, 0
+      self.degree[nid1] -= 1
+
+  def add_link(self, nid1, nid2, count):
+    """ Add /count/ links between switches /nid1/ and /nid2/"""
+    if nid1 not in self.switches or nid2 not in self.switches:
+      raise KeyError('Trying to insert edge at unrecognized node.')
+
+    if self.nlinks[nid1] + count > self.nports[nid1] or \
+      self.nlinks[nid2] + count > self.nports[nid2]:
+      raise Exception('Not enough ports for edge.')
+
+    for a, b in ((nid1, nid2), (nid2, nid1)):
+      self.set_ports(a, self.free_ports(a, count), b)
+      self.adjust_adjacency(a, b, count)
+      self.nlinks[a] += count
+
+    if self.is_up(nid1, nid2):
+      self.uplinks[nid1] += count
+    else:
+      self.uplinks[nid2] += count
+    self.touch(nid1, nid2)
+    if self.journal is not None:
+      self.journal.record(Journal.ADD_LINK, nid1, nid2, count)
+
+  def remove_link(self, nid1, nid2, count):
+    """ Remove /count/ links between switches /nid1/ and /nid2/""" 
+    if nid1 not in self.switches or nid2 not in self.switches:
+      raise KeyError('Trying to remove edge at unrecognized node.')
+
+    if self.link_count(nid1, nid2) - count < 0:
+      raise Exception('Not enough links to remove between nodes.')
+
+    for a, b in ((nid1, nid2), (nid2, nid1)):
+      ports = np.flatnonzero(self.port_peers(a) == b)
+      self.set_ports(a, ports[len(ports) - count:], -1)
+      self.adjust_adjacency(a, b, -count)
+      self.nlinks[a] -= count
+
+    if self.is_up(nid1, nid2):
+      self.uplinks[nid1] -= count
+    else:
+      self.uplinks[nid2] -= count
+    self.touch(nid1, nid2)
+    if self.journal is not None:
+      self.journal.record(Journal.REMOVE_LINK, nid1, nid2, count)
+
+  def slot_owners(self):
+    """ Switch id and 1-based port number of every used port slot """
+    sids = np.flatnonzero(self.stype >= 0)
+    sids = sids[np.argsort(self.base[sids], kind='stable')]
+    owner = np.repeat(sids, self.nports[sids])
+    return owner, np.arange(self.nslots) - self.base[owner] + 1
+
+  def snapshot_ports(self):
+    owner, port = self.slot_owners()
+    peer = self.peer[:self.nslots]
+    linked = peer >= 0
+    link_ports = np.stack([owner[linked], peer[linked], port[linked]], axis=1)
+    free_ports = np.stack([owner[~linked], port[~linked]], axis=1)
+    return link_ports, free_ports
+
+  def restore_ports(self, link_ports, free_ports):
+    if not len(link_ports):
+      return
+    sid, peer, port = link_ports[:, 0], link_ports[:, 1], link_ports[:, 2]
+    slots = self.base[sid] + port - 1
+    self.peer[slots] = peer
+    bits = np.zeros(8 * len(self.used), dtype=np.uint8)
+    bits[slots] = 1
+    self.used = np.packbits(bits, bitorder='little')
+
+    size = len(self.stype)
+    self.nlinks += np.bincount(sid, minlength=size)[:size].astype(np.int32)
+    up = self.stype[sid] < self.stype[peer]
+    self.uplinks += np.bincount(sid[up], minlength=size)[:size].astype(np.int32)
+    pairs, counts = np.unique(np.stack([sid, peer], axis=1), axis=0, return_counts=True)
+    for (a, b), count in zip(pairs.tolist(), counts.tolist()):
+      self.adjust_adjacency(a, b, count)
+
+  def link_count(self, nid1, nid2):
+    idx = self.slot(nid1, nid2)
+    return int(self.adj_count[idx]) if idx >= 0 else 0
+
+  def link_ports(self, nid1, nid2):
+    return [int(p) + 1 for p in np.flatnonzero(self.port_peers(nid1) == nid2)]
+
+  def uplink_ports(self, nid):
+    peers = self.port_peers(nid)
+    up = np.zeros(len(peers), dtype=bool)
+    up[peers >= 0] = self.stype[peers[peers >= 0]] > self.stype[nid]
+    return np.flatnonzero(up) + 1
+
+  def link_counts(self):
+    for nid in self.switches.keys():
+      base = self.base[nid]
+      for idx in range(base, base + self.degree[nid]):
+        if self.adj[idx] > nid:
+          yield (nid, int(self.adj[idx])), int(self.adj_count[idx])
+
+  def neighbors(self, nid, _type):
+    base = self.base[nid]
+    nbrs = self.adj[base:base + self.degree[nid]]
+    return [int(sid) for sid in nbrs[self.stype[nbrs] == STYPES.index(_type)]]
+
+  def is_up(self, nid1, nid2):
+    return self.stype[nid1] < self.stype[nid2]
+
+  def get_type(self, _type):
+    """ Ids of the switches of type /_type/ (shared index, do not mutate) """
+    if _type not in self.by_type:
+      code = STYPES.index(_type) if _type in STYPES else -2
+      self.by_type[_type] = [int(sid) for sid in np.flatnonzero(self.stype == code)]
+    return self.by_type[_type]
+
+  def linked(self, nid1, nid2):
+    return self.slot(nid1, nid2) >= 0
+
+  def core_agg_wiring(self):
+    """ Generate wiring matrix between core and agg levels """
+    cores = np.asarray(self.get_type('core'), dtype=np.int64)
+    aggs = np.asarray(self.get_type('agg'), dtype=np.int64)
+    agg_row = np.full(len(self.stype), -1, dtype=np.int64)
+    agg_row[aggs] = np.arange(len(aggs))
+    wiring = np.zeros((len(aggs), len(cores)))
+    for j, c_id in enumerate(cores):
+      base = self.base[c_id]
+      nbrs = self.adj[base:base + self.degree[c_id]]
+      counts = self.adj_count[base:base + self.degree[c_id]]
+      rows = agg_row[nbrs]
+      wiring[rows[rows >= 0], j] = counts[rows >= 0]
+    agg_key = {i: int(sid) for i, sid in enumerate(aggs)}
+    core_key = {j: int(sid) for j, sid in enumerate(cores)}
+    return wiring, agg_key, core_key
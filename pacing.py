@@ -0,0 +1,49 @@
+import time
+
+
+class Pacer(object):
+  """ Decides when a streamed rewiring reroutes and when it must wait
+
+  Rerouting is due once link changes are pending and /time_budget/ seconds
+  passed since the last rerouting. Applying further link changes waits
+  while more than /max_inflight/ FlowMods are unacknowledged, for at most
+  /max_wait/ seconds.
+
+  Args:
+        time_budget (float): seconds between reroutes
+        max_inflight (int): FlowMods allowed in flight before applying more
+          link changes
+        poll (float): seconds to sleep while waiting for FlowMods to drain
+        max_wait (float): seconds to wait for FlowMods to drain before
+          applying the next link change anyway
+        clock (callable): monotonic time source
+
+  """
+  def __init__(self, time_budget=0.5, max_inflight=256, poll=0.01,
+               max_wait=5.0, clock=time.monotonic):
+    self.time_budget = time_budget
+    self.max_inflight = max_inflight
+    self.poll = poll
+    self.max_wait = max_wait
+    self.clock = clock
+    self.pending = 0                      # link changes not rerouted yet
+    self.last = clock()                   # time of the last rerouting
+
+  def changed(self, count=1):
+    """ Record /count/ applied link changes """
+    self.pending += count
+
+  def due(self):
+    """ Whether the pending link changes should be rerouted now """
+    return self.pending > 0 and self.clock() - self.last >= self.time_budget
+
+  def rerouted(self, count=None):
+    """ Record that /count/ pending link changes, all if None, have been
+    rerouted """
+    self.pending = 0 if count is None else max(0, self.pending - count)
+    self.last = self.clock()
+
+  def can_apply(self, inflight):
+    """ Whether more link changes may be applied with /inflight/ FlowMods
+    still unacknowledged """
+    return inflight < self.max_inflight
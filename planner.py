@@ -0,0 +1,172 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from ILP import MinimalRewiringILP, InfeasibleRewiring
+
+
+class Schedule(object):
+  """ One way of carrying out a roadmap, and what it costs
+
+  Attributes:
+        order (list): windows of (level, num_ports) additions, in the order
+          they are carried out
+        lookahead (float): anchor weight pulling every intermediate target
+          towards the roadmap's final wiring
+        steps (list): RewirePlan of every window
+        wirings (list): target wiring after every window
+        moves (list): instructions of every window
+        total_moves (int): instructions over the whole roadmap
+
+  """
+  def __init__(self, order, lookahead, steps, wirings):
+    self.order = order
+    self.lookahead = lookahead
+    self.steps = steps
+    self.wirings = wirings
+    self.moves = [len(step) for step in steps]
+    self.total_moves = sum(self.moves)
+
+  def __repr__(self):
+    return "Schedule(total_moves={}, lookahead={}, order={})".format(
+              self.total_moves, self.lookahead, self.order)
+
+
+class ExpansionPlanner(object):
+  """ Plans a roadmap of block additions across several expansions
+
+  Every candidate schedule carries out the roadmap's windows in some order.
+  Each window rewires to an intermediate target solved by
+  MinimalRewiringILP. A lookahead weight pulls that target towards the
+  roadmap's final wiring, so a cheap window now does not force an
+  expensive one later. Every window is costed by the length of its
+  link_moves plan, and candidates are evaluated in a process pool.
+
+  Args:
+        initial_wiring (np.ndarray): current links between every pair of
+          server block and spine block
+        backend (string): MinimalRewiringILP backend; windows with a
+          lookahead always fall back to the ILP
+        lookahead (tuple): anchor weights to try, 0 for greedy windows
+        max_orderings (int): orderings evaluated, all distinct permutations
+          of the windows if there are at most that many, else the roadmap's
+          order plus a seeded random sample
+        workers (int): processes, os.cpu_count() if None, 0 to evaluate in
+          this process
+        seed (int): seed of the ordering sample
+
+  """
+  def __init__(self, initial_wiring, backend="flow", lookahead=(0.0, 0.5),
+               max_orderings=24, workers=None, seed=0):
+    self.initial_wiring = np.asarray(initial_wiring)
+    self.backend = backend
+    self.lookahead = tuple(lookahead)
+    self.max_orderings = max_orderings
+    self.workers = workers
+    self.seed = seed
+    self.candidates = []                  # every Schedule of the last plan
+
+  def plan(self, roadmap):
+    """ Cheapest schedule of /roadmap/
+
+    Args:
+          roadmap (list): windows, each a list of (level, num_ports)
+            additions or a single (level, num_ports) pair
+
+    Returns:
+          schedule (Schedule): schedule with the fewest total link moves,
+            the earliest candidate on ties
+
+    """
+    windows = [[tuple(window)] if isinstance(window[0], str)
+               else [tuple(a) for a in window] for window in roadmap]
+    candidates = [(order, weight) for order in self.orderings(windows)
+                  for weight in self.lookahead]
+    args = [(self.initial_wiring, self.backend, order, weight)
+            for order, weight in candidates]
+
+    workers = self.workers
+    if workers is None:
+      workers = os.cpu_count() or 1
+    if workers and len(args) > 1:
+      with ProcessPoolExecutor(max_workers=min(workers, len(args))) as pool:
+        results = list(pool.map(_evaluate, args))
+    else:
+      results = [_evaluate(arg) for arg in args]
+
+    self.candidates = [Schedule(order, weight, steps, wirings)
+                       for (order, weight), (steps, wirings) in zip(candidates, results)
+                       if steps is not None]
+    if not self.candidates:
+      raise Exception("No rewiring found for any ordering of the roadmap.")
+    return min(self.candidates, key=lambda schedule: schedule.total_moves)
+
+  def orderings(self, windows):
+    """ Distinct orderings of /windows/ to evaluate, the roadmap's own order
+    first. Equal windows are interchangeable, so orderings only differing
+    by swapping them are evaluated once. """
+    windows = [tuple(window) for window in windows]
+    if count_permutations(windows) <= self.max_orderings:
+      orders = list(unique_permutations(windows))
+    else:
+      rng = np.random.RandomState(self.seed)
+      orders, seen = [tuple(windows)], {tuple(windows)}
+      while len(orders) < self.max_orderings:
+        order = tuple(windows[i] for i in rng.permutation(len(windows)))
+        if order not in seen:
+          seen.add(order)
+          orders.append(order)
+    return [[list(window) for window in order] for order in orders]
+
+
+def count_permutations(items):
+  """ Number of distinct orderings of /items/, n! / prod(m!) over the
+  multiplicities m of equal items """
+  count, seen = 1, {}
+  for n, item in enumerate(items, 1):
+    seen[item] = seen.get(item, 0) + 1
+    count = count * n // seen[item]
+  return count
+
+
+def unique_permutations(items):
+  """ Distinct orderings of /items/ without repeats, /items/' own order
+  first """
+  if not items:
+    yield ()
+    return
+  for item in dict.fromkeys(items):
+    rest = list(items)
+    rest.remove(item)
+    for tail in unique_permutations(rest):
+      yield (item,) + tail
+
+
+def evaluate_schedule(initial_wiring, backend, order, lookahead):
+  """ Carry out the windows of /order/ one after the other
+
+  Returns:
+        steps (list): RewirePlan of every window
+        wirings (list): target wiring after every window
+
+  """
+  target = None
+  if lookahead > 0:
+    # the roadmap's final wiring, solved in one go
+    final = MinimalRewiringILP(initial_wiring.copy(), backend=backend)
+    final.solve_batch([a for window in order for a in window])
+    target = final.current_wiring
+
+  minwiring = MinimalRewiringILP(initial_wiring.copy(), backend=backend)
+  minwiring.anchor, minwiring.anchor_weight = target, lookahead
+  steps, wirings = [], []
+  for window in order:
+    steps.append(minwiring.rewire_batch(window))
+    wirings.append(minwiring.current_wiring)
+  return steps, wirings
+
+
+def _evaluate(args):
+  try:
+    return evaluate_schedule(*args)
+  except InfeasibleRewiring:
+    return None, None
@@ -0,0 +1,80 @@
+import hashlib, json, os, tempfile
+import numpy as np
+
+
+class RewiringCache(object):
+  """ Content-addressed on-disk cache of rewiring solutions
+
+  Every entry is one .npz file holding the target wiring and the link
+  movement plan, named after the hash of everything the solution depends
+  on. Reads refresh the file's modification time and writes evict the
+  least recently used entries once the directory grows past /max_bytes/.
+
+  Args:
+        path (string): cache directory, created if missing
+        max_bytes (int): size bound of the cache directory
+
+  """
+  def __init__(self, path, max_bytes=64 << 20):
+    self.path = path
+    self.max_bytes = max_bytes
+    os.makedirs(path, exist_ok=True)
+
+  def key(self, current_wiring, server_numports, spine_numports, additions,
+          backend=None):
+    """ Hash of a rewiring scenario """
+    digest = hashlib.sha256()
+    wiring = np.ascontiguousarray(np.round(current_wiring), dtype=np.int64)
+    digest.update(json.dumps(wiring.shape).encode())
+    digest.update(wiring.tobytes())
+    for ports in (server_numports, spine_numports):
+      digest.update(np.ascontiguousarray(np.round(ports), dtype=np.int64).tobytes())
+      digest.update(b'|')
+    scenario = [[level, int(num_ports)] for level, num_ports in additions]
+    digest.update(json.dumps([scenario, backend]).encode())
+    return digest.hexdigest()
+
+  def filename(self, key):
+    return os.path.join(self.path, key + '.npz')
+
+  def get(self, key):
+    """ Cached (wiring, plan) of /key/, or None """
+    filename = self.filename(key)
+    try:
+      with np.load(filename) as data:
+        wiring = data['wiring']
+        actions, servers, spines = data['actions'], data['servers'], data['spines']
+    except (OSError, KeyError, ValueError):
+      return None
+    os.utime(filename)
+    plan = [("CONNECT" if a else "DISCONNECT", int(s), int(p))
+            for a, s, p in zip(actions, servers, spines)]
+    return wiring, plan
+
+  def put(self, key, wiring, plan):
+    """ Store the target /wiring/ and link movement /plan/ under /key/ """
+    actions = np.array([action == "CONNECT" for action, _s, _p in plan], dtype=bool)
+    servers = np.array([s for _a, s, _p in plan], dtype=np.int32)
+    spines = np.array([p for _a, _s, p in plan], dtype=np.int32)
+
+    # write to a temporary file first so readers never see partial entries
+    fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as fp:
+      np.savez_compressed(fp, wiring=np.asarray(wiring, dtype=np.int64),
+                          actions=actions, servers=servers, spines=spines)
+    os.replace(tmp, self.filename(key))
+    self.evict()
+
+  def evict(self):
+    """ Remove least recently used entries until the cache fits """
+    entries = []
+    for name in os.listdir(self.path):
+      if name.endswith('.npz'):
+        stat = os.stat(os.path.join(self.path, name))
+        entries.append((stat.st_mtime, stat.st_size, name))
+    total = sum(size for _mtime, size, _name in entries)
+    for _mtime, size, name in sorted(entries):
+      if total <= self.max_bytes:
+        break
+      os.remove(os.path.join(self.path, name))
+      total -= size
@@ -0,0 +1,64 @@
+import numpy as np
+
+
+class InfeasibleRewiring(Exception):
+  """ No target wiring satisfies the port and even distribution constraints """
+
+
+def rewiring_objective(wiring, current_wiring):
+  """ Objective of the rewiring problem: links changed minus links used """
+  return np.abs(wiring - current_wiring).sum() - wiring.sum()
+
+
+def flow_rewiring(current_wiring, server_numports, spine_numports):
+  """ Exact solution of the rewiring problem as a bipartite max-flow
+
+  The even distribution constraints pin every cell to floor(k_i) or
+  ceil(k_i), so each cell is a 0/1 choice on top of its floor. Raising a
+  cell lowers the objective by 2 when the current wiring already has the
+  extra link and leaves it unchanged otherwise, so the optimum is the
+  largest set of such cells that fits the residual row and column port
+  budgets, i.e. a maximum flow.
+
+  Args:
+        current_wiring (np.ndarray): current links, padded to the target shape
+        server_numports (np.ndarray): number of ports of every server block
+        spine_numports (np.ndarray): number of ports of every spine block
+
+  Returns:
+        wiring (np.ndarray): optimal target wiring
+
+  """
+  nsv, nsp = current_wiring.shape
+  k = np.asarray(server_numports, dtype=float) / float(nsp)
+  lower = np.floor(k).astype(int)
+  upper = np.ceil(k).astype(int)
+
+  # port budgets left once every cell sits at its floor
+  row_cap = np.round(server_numports).astype(int) - nsp * lower
+  col_cap = np.round(spine_numports).astype(int) - lower.sum()
+  if (row_cap < 0).any() or (col_cap < 0).any():
+    raise InfeasibleRewiring("No rewiring found under given parameters.")
+
+  wiring = np.repeat(lower[:, None], nsp, axis=1)
+
+  # cells where adding the link on top of the floor keeps an existing link
+  gain = (upper > lower)[:, None] & (current_wiring >= lower[:, None] + 1)
+  gain &= (row_cap > 0)[:, None] & (col_cap > 0)[None, :]
+  rows, cols = np.nonzero(gain)
+  if not len(rows):
+    return wiring
+
+  import networkx as nx
+  G = nx.DiGraph()
+  for i in np.unique(rows):
+    G.add_edge('src', ('sv', i), capacity=int(row_cap[i]))
+  for j in np.unique(cols):
+    G.add_edge(('sp', j), 'dst', capacity=int(col_cap[j]))
+  for i, j in zip(rows, cols):
+    G.add_edge(('sv', i), ('sp', j), capacity=1)
+
+  _, flow = nx.maximum_flow(G, 'src', 'dst')
+  for i, j in zip(rows, cols):
+    wiring[i, j] += flow[('sv', i)][('sp', j)]
+  return wiring
@@ -0,0 +1,246 @@
+import numpy as np
+
+
+class CapacityReport(object):
+  """ Agg->core capacity of every intermediate wiring of a plan, step 0
+  being the wiring before the first instruction
+
+  Attributes:
+        uplinks (np.ndarray): core links of every agg, (steps + 1, aggs)
+        capacity (np.ndarray): total agg->core links per step
+        min_uplinks (np.ndarray): fewest core links of an agg serving edges
+        oversubscription (np.ndarray): largest edge:core link ratio of an
+          agg serving edges, inf once such an agg has no core link
+        pod_throughput (np.ndarray): smallest capacity through the cores
+          between two pods with aggs serving edges, inf with fewer than two
+          such pods
+
+  """
+  def __init__(self, uplinks, capacity, min_uplinks, oversubscription,
+               pod_throughput):
+    self.uplinks = uplinks
+    self.capacity = capacity
+    self.min_uplinks = min_uplinks
+    self.oversubscription = oversubscription
+    self.pod_throughput = pod_throughput
+
+  @property
+  def worst_step(self):
+    """ Step with the lowest pod-to-pod throughput, then fewest uplinks """
+    return int(np.lexsort((self.min_uplinks, self.pod_throughput))[0])
+
+
+class CapacitySimulator(object):
+  """ Replays link movement plans over a core:agg wiring matrix
+
+  Rows of the wiring are aggs (server blocks) and columns cores (spine
+  blocks), as in MinimalRewiringILP. The pod-to-pod capacity of pods P
+  and Q is sum over cores c of min(X[P, c], X[Q, c]), where X sums the
+  links of a pod's aggs.
+
+  Args:
+        wiring (np.ndarray): links between every agg and core
+        pods (np.ndarray): pod of every agg row, one pod per agg if None
+        down (np.ndarray): edge links of every agg row, the agg's initial
+          core links if None. Aggs without edge links carry no traffic.
+
+  """
+  def __init__(self, wiring, pods=None, down=None):
+    self.wiring = np.asarray(wiring, dtype=np.int64)
+    n_aggs = self.wiring.shape[0]
+    self.pods = np.arange(n_aggs) if pods is None else np.asarray(pods, dtype=np.int64)
+    self.down = self.wiring.sum(axis=1) if down is None else np.asarray(down, dtype=np.int64)
+
+  @classmethod
+  def from_network(cls, network):
+    """ Simulator over the core:agg wiring of /network/, with pods of aggs
+    linked to the same edges and edge links counted as downlinks """
+    wiring, agg_key, _core_key = network.core_agg_wiring()
+    pod_aggs = network.route_index()['pod_aggs']
+    pods = np.empty(len(agg_key), dtype=np.int64)
+    down = np.empty(len(agg_key), dtype=np.int64)
+    for i in range(len(agg_key)):
+      a_id = agg_key[i]
+      pods[i] = next((g for g, aggs in enumerate(pod_aggs) if a_id in aggs),
+                     len(pod_aggs) + i)
+      sw = network.switches[a_id]
+      down[i] = sw.nlinks - sw.uplinks
+    return cls(wiring, pods, down)
+
+  def shaped(self, plan):
+    """ Wiring, pods and downlinks padded to the blocks /plan/ refers to """
+    plan = list(plan)
+    n_aggs = max([s + 1 for _a, s, _p in plan] + [self.wiring.shape[0]])
+    n_cores = max([p + 1 for _a, _s, p in plan] + [self.wiring.shape[1]])
+    wiring = np.zeros((n_aggs, n_cores), dtype=np.int64)
+    wiring[:self.wiring.shape[0], :self.wiring.shape[1]] = self.wiring
+    extra = n_aggs - self.wiring.shape[0]
+    pods = np.concatenate([self.pods, self.pods.max(initial=-1) + 1 + np.arange(extra)])
+    down = np.concatenate([self.down, np.zeros(extra, dtype=np.int64)])
+    return wiring, pods, down
+
+  def replay(self, plan, chunk=None):
+    """ Capacity after every instruction of /plan/
+
+    Args:
+          plan (list): ("CONNECT" or "DISCONNECT", server, spine) tuples
+          chunk (int): steps whose pod matrices are held at once, bounding
+            memory to about four million entries if None
+
+    Returns:
+          report (CapacityReport): per step capacity
+
+    """
+    plan = list(plan)
+    wiring, pods, down = self.shaped(plan)
+    steps = len(plan)
+    sign = np.array([1 if a == "CONNECT" else -1 for a, _s, _p in plan], dtype=np.int64)
+    s = np.array([s for _a, s, _p in plan], dtype=np.int64)
+    p = np.array([p for _a, _s, p in plan], dtype=np.int64)
+
+    delta = np.zeros((steps, wiring.shape[0]), dtype=np.int64)
+    delta[np.arange(steps), s] = sign
+    uplinks = wiring.sum(axis=1) + np.vstack([np.zeros((1, wiring.shape[0]), dtype=np.int64),
+                                              np.cumsum(delta, axis=0)])
+    active = down > 0
+    if active.any():
+      up = uplinks[:, active]
+      min_uplinks = up.min(axis=1)
+      with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.where(up > 0, down[active] / np.maximum(up, 1), np.inf)
+      oversubscription = ratio.max(axis=1)
+    else:
+      min_uplinks = np.zeros(steps + 1, dtype=np.int64)
+      oversubscription = np.zeros(steps + 1)
+
+    # wiring of the pods carrying traffic, advanced one chunk of steps at a
+    # time; aggs of other pods are left out
+    used_pods, pod_row = np.unique(pods[active], return_inverse=True)
+    row = np.full(int(pods.max()) + 1, -1, dtype=np.int64)
+    row[used_pods] = np.arange(len(used_pods))
+    agg_pod = row[pods]
+    n_pods = len(used_pods)
+    pod_wiring = np.zeros((n_pods, wiring.shape[1]), dtype=np.int64)
+    np.add.at(pod_wiring, agg_pod[agg_pod >= 0], wiring[agg_pod >= 0])
+    keep = agg_pod[s] >= 0
+    throughput = np.full(steps + 1, np.inf)
+    if n_pods > 1:
+      if chunk is None:
+        chunk = max(1, (1 << 22) // (n_pods * n_pods * wiring.shape[1]))
+      throughput[0] = self.pod_throughput(pod_wiring[None])[0]
+      for t0 in range(0, steps, chunk):
+        t1 = min(steps, t0 + chunk)
+        changes = np.zeros((t1 - t0, n_pods, wiring.shape[1]), dtype=np.int64)
+        k = keep[t0:t1]
+        changes[np.arange(t1 - t0)[k], agg_pod[s[t0:t1]][k], p[t0:t1][k]] = sign[t0:t1][k]
+        X = pod_wiring + np.cumsum(changes, axis=0)
+        throughput[t0 + 1:t1 + 1] = self.pod_throughput(X)
+        pod_wiring = X[-1]
+
+    return CapacityReport(uplinks, uplinks.sum(axis=1), min_uplinks,
+                          oversubscription, throughput)
+
+  def pod_throughput(self, X):
+    """ Smallest pod pair capacity of every pod wiring in /X/, (steps,
+    pods, cores) """
+    pairs = np.minimum(X[:, :, None, :], X[:, None, :, :]).sum(-1).astype(float)
+    n_pods = X.shape[1]
+    pairs[:, np.arange(n_pods), np.arange(n_pods)] = np.inf
+    return pairs.reshape(len(X), -1).min(axis=1)
+
+  def reorder(self, plan):
+    """ Reorder /plan/ to keep capacity high during the transition: links
+    are connected as soon as their core has a free port, and a link is only
+    disconnected when no connection can proceed, from the agg with the most
+    core links among the cores a pending connection waits for. A link the
+    plan both connects and disconnects, as chained moves do, is left alone.
+    Reaches the same final wiring without exceeding core ports or removing
+    a missing link, given the core port counts implied by /plan/ being valid.
+
+    Returns:
+          plan (list): reordered instructions
+
+    """
+    plan = list(plan)
+    wiring, _pods, _down = self.shaped(plan)
+    # free ports of every core: the most links it holds along the plan
+    used = wiring.sum(axis=0)
+    peak = used.copy()
+    for action, _s, p in plan:
+      used[p] += 1 if action == "CONNECT" else -1
+      peak[p] = max(peak[p], used[p])
+    free = peak - wiring.sum(axis=0)
+
+    uplinks = wiring.sum(axis=1)
+    connects = [(s, p) for a, s, p in plan if a == "CONNECT"]
+    disconnects = [(s, p) for a, s, p in plan if a != "CONNECT"]
+    # transient links cancel out
+    for link in list(connects):
+      if link in disconnects:
+        connects.remove(link)
+        disconnects.remove(link)
+    ordered = []
+    while connects or disconnects:
+      blocked = []
+      for s, p in connects:
+        if free[p] > 0:
+          free[p] -= 1
+          uplinks[s] += 1
+          wiring[s, p] += 1
+          ordered.append(("CONNECT", s, p))
+        else:
+          blocked.append((s, p))
+      progressed = len(blocked) < len(connects)
+      connects = blocked
+      if progressed or not connects and not disconnects:
+        continue
+      if not disconnects:
+        raise Exception("No core port left for the remaining connections.")
+
+      waiting = set(p for _s, p in connects)
+      present = [d for d in disconnects if wiring[d] > 0]
+      if not present:
+        raise Exception("No link left to disconnect for the remaining connections.")
+      candidates = [d for d in present if d[1] in waiting] or present
+      s, p = max(candidates, key=lambda d: uplinks[d[0]])
+      disconnects.remove((s, p))
+      free[p] += 1
+      uplinks[s] -= 1
+      wiring[s, p] -= 1
+      ordered.append(("DISCONNECT", s, p))
+    return ordered
+
+  def recommend_pace(self, plan, max_loss=0.25):
+    """ Largest number of instructions between reroutes such that no agg
+    serving edges loses more than /max_loss/ of its core links while its
+    routes still point at them, see Controller.add_switches
+
+    Returns:
+          pace (int): instructions between reroutes, at least 1
+
+    """
+    plan = list(plan)
+    if not plan:
+      return 1
+    report = self.replay(plan)
+    _wiring, _pods, down = self.shaped(plan)
+    active = down > 0
+    removed = np.zeros((len(plan), len(down)), dtype=np.int64)
+    for t, (action, s, _p) in enumerate(plan):
+      if action != "CONNECT":
+        removed[t, s] = 1
+    cum = np.vstack([np.zeros((1, len(down)), dtype=np.int64), np.cumsum(removed, axis=0)])
+
+    best = 1
+    for pace in range(1, len(plan) + 1):
+      # the controller applies pace instructions, then reroutes
+      starts = np.arange(0, len(plan), pace)
+      ends = np.minimum(starts + pace, len(plan))
+      lost = cum[ends][:, active] - cum[starts][:, active]
+      base = report.uplinks[starts][:, active]
+      with np.errstate(divide='ignore', invalid='ignore'):
+        loss = np.where(base > 0, lost / np.maximum(base, 1), 0.0)
+      if loss.size and loss.max() > max_loss:
+        break
+      best = pace
+    return best
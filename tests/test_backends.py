@@ -0,0 +1,8 @@
+from ILP import cross_check_backends
+
+
+def test_backends_agree():
+  objectives = cross_check_backends(trials=20, seed=1)
+  assert objectives
+  for ilp, flow in objectives:
+    assert abs(ilp - flow) < 1e-6
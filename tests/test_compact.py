@@ -0,0 +1,37 @@
+from benchmarks.clos import fat_tree, heterogeneous_clos
+
+
+def graph_data(net):
+  G = net.to_nx()
+  return sorted(G.nodes(data=True)), sorted((min(a, b), max(a, b), d['count'])
+                                            for a, b, d in G.edges(data=True))
+
+
+def check_same(net, compact):
+  wiring, agg_key, core_key = net.core_agg_wiring()
+  other = compact.core_agg_wiring()
+  assert (wiring == other[0]).all() and agg_key == other[1] and core_key == other[2]
+  assert graph_data(net) == graph_data(compact)
+
+
+def test_compact_matches_network():
+  for build in (lambda compact: fat_tree(4, compact=compact),
+                lambda compact: heterogeneous_clos(4, 4, 1, 4, seed=1, compact=compact)):
+    net, _wiring = build(False)
+    compact, _wiring = build(True)
+    check_same(net, compact)
+    for mode in ('ecmp', 'wcmp'):
+      net.route_ecmp(seed=7, mode=mode)
+      compact.route_ecmp(seed=7, mode=mode)
+      sids = [sid for _type in ('edge', 'agg', 'core') for sid in net.get_type(_type)]
+      assert net.routes.hosts == compact.routes.hosts
+      assert (net.routes.get_rows(sids) == compact.routes.get_rows(sids)).all()
+
+    # link changes may land on other ports, but not change the topology
+    a_id = net.get_type('agg')[0]
+    c_id = net.neighbors(a_id, 'core')[0]
+    for n in (net, compact):
+      n.remove_link(a_id, c_id, 1)
+      n.add_link(c_id, a_id, 1)
+      n.remove_link(net.get_type('host')[0], net.get_type('edge')[0], 1)
+    check_same(net, compact)
@@ -0,0 +1,29 @@
+import numpy as np
+from ILP import MinimalRewiringILP, InfeasibleRewiring
+
+
+def apply_plan(wiring, plan):
+  wiring = np.array(wiring, dtype=int)
+  for action, s, p in plan:
+    wiring[s, p] += 1 if action == "CONNECT" else -1
+  return wiring
+
+
+def test_link_moves_reach_target():
+  rng = np.random.RandomState(0)
+  checked = 0
+  for _ in range(300):
+    shape = rng.randint(1, 7, size=2)
+    wiring = rng.randint(0, 5, size=shape)
+    level = "spine" if rng.rand() < 0.5 else "server"
+    minwiring = MinimalRewiringILP(wiring.copy(), backend="flow")
+    try:
+      plan = minwiring.rewire(level, rng.randint(1, 25))
+    except InfeasibleRewiring:
+      continue
+    old_wiring = np.zeros(minwiring.current_wiring.shape, dtype=int)
+    old_wiring[:wiring.shape[0], :wiring.shape[1]] = wiring
+    minwiring.check_plan(old_wiring, plan)
+    assert (apply_plan(old_wiring, plan) == minwiring.current_wiring).all()
+    checked += 1
+  assert checked > 0
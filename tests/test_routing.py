@@ -0,0 +1,66 @@
+import copy
+import numpy as np
+from benchmarks.clos import fat_tree
+
+
+def routed_sids(net):
+  return [sid for _type in ('edge', 'agg', 'core') for sid in net.get_type(_type)]
+
+
+def check_against_fresh(net):
+  """ Routes of /net/ after route_incremental against a fresh route_ecmp:
+  equal except that ECMP cores may keep any still valid port """
+  fresh = copy.deepcopy(net)
+  fresh.route_ecmp()
+  hosts = net.route_index()['hosts']
+  edge_of = dict(zip(hosts.tolist(), net.route_index()['edge'].tolist()))
+  for sid in routed_sids(net):
+    rows, expected = net.routes.get_rows([sid])[0], fresh.routes.get_rows([sid])[0]
+    assert ((rows >= 0) == (expected >= 0)).all(), sid
+    if net.route_mode == 'ecmp' and net.switches[sid].stype == 'core':
+      valid = {}
+      for a_id in net.neighbors(sid, 'agg'):
+        for port in net.link_ports(sid, a_id):
+          valid[port] = set(net.neighbors(a_id, 'edge'))
+      for h_id in np.asarray(net.routes.hosts)[rows >= 0].tolist():
+        assert edge_of[h_id] in valid[net.routes[sid][h_id]], (sid, h_id)
+    else:
+      assert (rows == expected).all(), sid
+
+
+def check_changes(compact, mode):
+  net, _wiring = fat_tree(4, compact=compact)
+  net.route_ecmp(seed=3, mode=mode)
+  hosts, edges = net.get_type('host'), net.get_type('edge')
+  aggs = net.get_type('agg')
+
+  # a new host takes the port of a host moved off its edge
+  h_id, e_id = hosts[0], edges[0]
+  net.remove_link(h_id, e_id, 1)
+  net.route_incremental()
+  check_against_fresh(net)
+  net.add_switch(net.max_sid + 1, 1, 'host')
+  net.add_link(net.max_sid, e_id, 1)
+  net.route_incremental()
+  check_against_fresh(net)
+
+  # edge:agg
+  a_id = net.neighbors(edges[-1], 'agg')[0]
+  net.remove_link(edges[-1], a_id, 1)
+  net.route_incremental()
+  check_against_fresh(net)
+
+  # agg:core, and back
+  c_id = net.neighbors(aggs[1], 'core')[0]
+  net.remove_link(aggs[1], c_id, 1)
+  net.route_incremental()
+  check_against_fresh(net)
+  net.add_link(aggs[1], c_id, 1)
+  net.route_incremental()
+  check_against_fresh(net)
+
+
+def test_incremental_matches_fresh_routing():
+  for compact in (False, True):
+    for mode in ('ecmp', 'wcmp'):
+      check_changes(compact, mode)
@@ -0,0 +1,34 @@
+import numpy as np
+from ILP import MinimalRewiringILP, InfeasibleRewiring
+from simulate import CapacitySimulator
+from tests.test_link_moves import apply_plan
+
+
+def test_reorder_keeps_plans_valid():
+  rng = np.random.RandomState(0)
+  checked = 0
+  for _ in range(700):
+    shape = rng.randint(2, 6, size=2)
+    wiring = rng.randint(0, 5, size=shape)
+    level = "spine" if rng.rand() < 0.5 else "server"
+    minwiring = MinimalRewiringILP(wiring.copy(), backend="flow")
+    try:
+      plan = minwiring.rewire(level, rng.randint(1, 25))
+    except InfeasibleRewiring:
+      continue
+    old_wiring = np.zeros(minwiring.current_wiring.shape, dtype=int)
+    old_wiring[:wiring.shape[0], :wiring.shape[1]] = wiring
+    reordered = CapacitySimulator(old_wiring).reorder(plan)
+    minwiring.check_plan(old_wiring, reordered)
+    assert (apply_plan(old_wiring, reordered) == minwiring.current_wiring).all()
+    checked += 1
+  assert checked > 0
+
+
+def test_reorder_chained_moves():
+  wiring = np.array([[3, 4, 1, 0], [1, 3, 0, 2], [1, 2, 0, 2], [4, 0, 4, 3]])
+  minwiring = MinimalRewiringILP(wiring.copy(), backend="flow")
+  plan = minwiring.rewire('spine', 17)
+  old_wiring = np.zeros(minwiring.current_wiring.shape, dtype=int)
+  old_wiring[:4, :4] = wiring
+  minwiring.check_plan(old_wiring, CapacitySimulator(old_wiring).reorder(plan))